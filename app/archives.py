@@ -0,0 +1,181 @@
+import hashlib
+import io
+import shutil
+import tarfile
+import tempfile
+import uuid
+import zipfile
+from collections import namedtuple
+from datetime import datetime
+
+import anyio
+from sqlalchemy import func, update
+
+from app.config import DOWNLOAD_CHUNK_SIZE, INGEST_BATCH_SIZE, UPLOAD_CONCURRENCY
+from app.ingest import SpooledImage, store_images
+from app.metrics import allow_repeated_statements
+from app.models import Ingest
+from app.storage import daily_bucket_name, storage
+from app.thumbnails import derivative_queue
+
+ZIP_MAGIC = b'PK\x03\x04'
+
+# Image read from an archive, spooled and hashed. Entries which are not images have no file.
+ArchiveEntry = namedtuple('ArchiveEntry', ['name', 'file', 'key', 'size'])
+
+# Raised for archives which can't be read, the images saved before the error stay
+ArchiveError = (tarfile.TarError, zipfile.BadZipFile, EOFError)
+
+
+class BodyReader(io.RawIOBase):
+    # Blocking file over the request body for tarfile and zipfile, used from a worker thread
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    async def next_chunk(self):
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def readinto(self, buffer) -> int:
+        while not self.chunk:
+            chunk = anyio.from_thread.run(self.next_chunk)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+
+def spool_entry(name: str, data) -> ArchiveEntry:
+    # The image is hashed while it is copied, big ones go to disk
+    if not name.lower().endswith('.jpg'):
+        return ArchiveEntry(name, None, None, 0)
+
+    file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: data.read(DOWNLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+        file.write(chunk)
+    size = file.tell()
+    file.seek(0)
+    return ArchiveEntry(name, file, digest.hexdigest(), size)
+
+
+def read_archive(body, emit):
+    # Calls emit with every file of a tar (plain or compressed) or zip archive, blocking
+    if not isinstance(body, io.BufferedReader):
+        body = io.BufferedReader(body, DOWNLOAD_CHUNK_SIZE)
+
+    # Zip keeps its directory at the end, so it is spooled to disk first. Tar is read as it arrives.
+    if body.peek(len(ZIP_MAGIC))[:len(ZIP_MAGIC)] == ZIP_MAGIC:
+        with tempfile.TemporaryFile() as file:
+            shutil.copyfileobj(body, file, DOWNLOAD_CHUNK_SIZE)
+            with zipfile.ZipFile(file) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        with archive.open(info) as data:
+                            emit(spool_entry(info.filename, data))
+    else:
+        with tarfile.open(fileobj=body, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    emit(spool_entry(member.name, archive.extractfile(member)))
+
+
+def close_entries(entries: list):
+    for entry in entries:
+        if entry.file:
+            entry.file.close()
+
+
+async def store_batch(database, request_code: str, created_at: datetime, entries: list):
+    # One transaction per batch
+    images = [SpooledImage(str(uuid.uuid4()), entry.file, entry.key, entry.size) for entry in entries if entry.file]
+    new_keys = await store_images(database, request_code, created_at, images, skipped=len(entries) - len(images))
+    await database.commit()
+
+    for key in new_keys:
+        derivative_queue.enqueue(daily_bucket_name(created_at), key)
+
+
+async def ingest_archive(chunks, database, user_id: int, request_code: str, created_at: datetime) -> Ingest:
+    # Images of the archive are saved under one request code, progress can be read from its ingest row
+    ingest = Ingest(request_code=request_code, user_id=user_id, status='running', stored=0, skipped=0)
+    database.add(ingest)
+    await database.commit()
+
+    # Every batch runs the same statements
+    allow_repeated_statements()
+    await storage.ensure_bucket(daily_bucket_name(created_at))
+
+    # The reader thread stops on a full stream, so a few entries are spooled ahead of the saved batch
+    send_stream, receive_stream = anyio.create_memory_object_stream(UPLOAD_CONCURRENCY)
+
+    def emit(entry: ArchiveEntry):
+        try:
+            anyio.from_thread.run(send_stream.send, entry)
+        except anyio.BrokenResourceError:
+            close_entries([entry])
+            raise
+
+    # Errors of the archive are raised after the images read before them are saved
+    read_error = None
+
+    async def read():
+        nonlocal read_error
+        async with send_stream:
+            try:
+                await anyio.to_thread.run_sync(read_archive, BodyReader(chunks), emit)
+            except anyio.BrokenResourceError:
+                # Saving failed and closed the stream, its error is raised
+                pass
+            except Exception as error:
+                read_error = error
+
+    try:
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(read)
+
+            async with receive_stream:
+                batch = []
+                async for entry in receive_stream:
+                    batch.append(entry)
+                    if len(batch) >= INGEST_BATCH_SIZE:
+                        try:
+                            await store_batch(database, request_code, created_at, batch)
+                        finally:
+                            close_entries(batch)
+                        batch = []
+
+                try:
+                    await store_batch(database, request_code, created_at, batch)
+                finally:
+                    close_entries(batch)
+
+        if read_error:
+            raise read_error
+    except Exception as error:
+        # Saved batches stay, the ingest shows where it stopped
+        await database.rollback()
+        await database.execute(update(Ingest).where(Ingest.request_code == request_code).values(
+            status='failed', error=str(error) or type(error).__name__, updated_at=func.now()
+        ))
+        await database.commit()
+        raise
+
+    await database.execute(update(Ingest).where(Ingest.request_code == request_code).values(
+        status='done', updated_at=func.now()
+    ))
+    await database.commit()
+    await database.refresh(ingest)
+    return ingest
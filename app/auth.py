@@ -0,0 +1,47 @@
+from collections import namedtuple
+
+from fastapi import Depends, HTTPException
+from sqlalchemy import select
+from starlette import status
+
+from app.cache import TTLCache
+from app.config import AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+from app.models import connect_db, User, AuthToken
+
+TokenOwner = namedtuple('TokenOwner', ['user_id', 'group'])
+
+# Token -> TokenOwner. Every worker process has its own cache, so a rotated token
+# may still be accepted by other workers for up to AUTH_CACHE_TTL seconds.
+token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+
+async def get_token_owner(auth_token: str, database=Depends(connect_db)) -> TokenOwner:
+
+    # Get user of token from cache
+    owner = token_cache.get(auth_token)
+    if owner is not None:
+        return owner
+
+    # If token not in cache, get token with user group from db
+    row = (await database.execute(
+        select(AuthToken.user_id, User.group).join(User, User.id == AuthToken.user_id).where(
+            AuthToken.token == auth_token
+        )
+    )).one_or_none()
+
+    # Checking if the token exist
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='AuthToken dont exist')
+
+    owner = TokenOwner(*row)
+    token_cache.set(auth_token, owner)
+    return owner
+
+
+async def get_staff_owner(owner: TokenOwner = Depends(get_token_owner)) -> TokenOwner:
+
+    # If user group not admin/moderator raise exception
+    if owner.group not in ['admin', 'moderator']:
+        raise HTTPException(status_code=status.HTTP_405_METHOD_NOT_ALLOWED, detail='You must be admin/moderator')
+
+    return owner
@@ -0,0 +1,347 @@
+import hashlib
+import hmac
+import io
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import timedelta
+from urllib.parse import quote
+
+from minio import Minio
+from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
+
+from app.config import SECRET_KEY, STORAGE_PATH, STORAGE_PUBLIC_URL
+from app.models import minio_client
+
+# Blocking storage backends, app.storage.Storage runs their methods in worker threads.
+# Every backend has the same methods as MinioBackend and raises StorageError with S3 error codes.
+
+ObjectStat = namedtuple('ObjectStat', ['size', 'etag'])
+
+
+class StorageError(Exception):
+
+    def __init__(self, code: str, message: str = '', name: str = None):
+        super().__init__(f'{code}: {message}' if message else code)
+        self.code = code
+        self.message = message
+        # Object name, set for errors of multi-object deletes
+        self.name = name
+
+
+def url_signature(method: str, bucket_name: str, object_name: str, expires_at: int) -> str:
+    message = f'{method}\n{bucket_name}\n{object_name}\n{expires_at}'.encode('utf8')
+    return hmac.new(str(SECRET_KEY).encode('utf8'), message, hashlib.sha256).hexdigest()
+
+
+def check_signature(method: str, bucket_name: str, object_name: str, expires_at: int, signature: str) -> bool:
+    return expires_at >= time.time() and hmac.compare_digest(
+        url_signature(method, bucket_name, object_name, expires_at), signature
+    )
+
+
+class SignedUrls:
+    # Backends without their own server give out urls of /storage routes of the app, signed with SECRET_KEY
+
+    def signed_url(self, method: str, bucket_name: str, object_name: str, expires: timedelta) -> str:
+        expires_at = int(time.time() + expires.total_seconds())
+        signature = url_signature(method, bucket_name, object_name, expires_at)
+        return f'{STORAGE_PUBLIC_URL}/storage/{quote(bucket_name)}/{quote(object_name)}' \
+               f'?expires={expires_at}&signature={signature}'
+
+    def presigned_get_url(self, bucket_name: str, object_name: str, expires: timedelta) -> str:
+        return self.signed_url('GET', bucket_name, object_name, expires)
+
+    def presigned_put_url(self, bucket_name: str, object_name: str, expires: timedelta) -> str:
+        return self.signed_url('PUT', bucket_name, object_name, expires)
+
+
+class MinioObject:
+
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, size: int) -> bytes:
+        return self.response.read(size)
+
+    def close(self):
+        # Connection goes back to the pool
+        self.response.close()
+        self.response.release_conn()
+
+
+class MinioBackend:
+
+    def __init__(self, client: Minio):
+        self.client = client
+
+    def call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except S3Error as error:
+            raise StorageError(error.code, error.message) from error
+
+    def list_buckets(self) -> list:
+        return [bucket.name for bucket in self.call(self.client.list_buckets)]
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return self.call(self.client.bucket_exists, bucket_name)
+
+    def make_bucket(self, bucket_name: str):
+        self.call(self.client.make_bucket, bucket_name)
+
+    def remove_bucket(self, bucket_name: str):
+        self.call(self.client.remove_bucket, bucket_name)
+
+    def list_objects(self, bucket_name: str) -> list:
+        return self.call(lambda: [item.object_name for item in self.client.list_objects(bucket_name,
+                                                                                        recursive=True)])
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, **kwargs):
+        self.call(self.client.put_object, bucket_name, object_name, data, length, **kwargs)
+
+    def stat_object(self, bucket_name: str, object_name: str) -> ObjectStat:
+        stat = self.call(self.client.stat_object, bucket_name, object_name)
+        return ObjectStat(stat.size, stat.etag)
+
+    def get_object(self, bucket_name: str, object_name: str, offset: int = 0, length: int = 0) -> MinioObject:
+        return MinioObject(self.call(self.client.get_object, bucket_name, object_name, offset, length))
+
+    def remove_object(self, bucket_name: str, object_name: str):
+        self.call(self.client.remove_object, bucket_name, object_name)
+
+    def remove_objects(self, bucket_name: str, object_names: list) -> list:
+        # remove_objects is lazy, the request is only sent while its errors are iterated
+        errors = self.call(lambda: list(self.client.remove_objects(
+            bucket_name, [DeleteObject(object_name) for object_name in object_names]
+        )))
+        return [StorageError(error.code, error.message, error.name) for error in errors]
+
+    def presigned_get_url(self, bucket_name: str, object_name: str, expires: timedelta) -> str:
+        # Signing is local (region is set on the client)
+        return self.client.presigned_get_object(bucket_name, object_name, expires=expires)
+
+    def presigned_put_url(self, bucket_name: str, object_name: str, expires: timedelta) -> str:
+        return self.client.presigned_put_object(bucket_name, object_name, expires=expires)
+
+
+def check_name(name: str) -> str:
+    # Buckets are directories and objects are files, names must not leave them
+    if not name or '/' in name or '\\' in name or name.startswith('.'):
+        raise StorageError('InvalidObjectName', f'Invalid name {name}')
+    return name
+
+
+def file_descriptor(data):
+    # Real files can be copied by the kernel, data in memory can't
+    if isinstance(data, tempfile.SpooledTemporaryFile):
+        # Asking a spooled file for fileno would write it to disk first
+        data = data._file
+    try:
+        return data.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+class MappedObject:
+    # Reads a file through mmap, pages come straight from the page cache
+
+    def __init__(self, file, offset: int, length: int):
+        self.file = file
+        size = os.fstat(file.fileno()).st_size
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if size and hasattr(self.map, 'madvise'):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.position = min(offset, size)
+        self.end = min(offset + length, size) if length else size
+
+    def read(self, size: int) -> bytes:
+        chunk = self.map[self.position:min(self.position + size, self.end)]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+class LocalBackend(SignedUrls):
+    # Buckets are directories under root, objects are files in them
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def bucket_path(self, bucket_name: str) -> str:
+        return os.path.join(self.root, check_name(bucket_name))
+
+    def object_path(self, bucket_name: str, object_name: str) -> str:
+        bucket_path = self.bucket_path(bucket_name)
+        if not os.path.isdir(bucket_path):
+            raise StorageError('NoSuchBucket', f'Bucket {bucket_name} does not exist')
+        return os.path.join(bucket_path, check_name(object_name))
+
+    def list_buckets(self) -> list:
+        return [entry.name for entry in os.scandir(self.root) if entry.is_dir() and not entry.name.startswith('.')]
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return os.path.isdir(self.bucket_path(bucket_name))
+
+    def make_bucket(self, bucket_name: str):
+        try:
+            os.mkdir(self.bucket_path(bucket_name))
+        except FileExistsError:
+            raise StorageError('BucketAlreadyOwnedByYou', f'Bucket {bucket_name} already exists')
+
+    def remove_bucket(self, bucket_name: str):
+        try:
+            os.rmdir(self.bucket_path(bucket_name))
+        except FileNotFoundError:
+            raise StorageError('NoSuchBucket', f'Bucket {bucket_name} does not exist')
+        except OSError:
+            raise StorageError('BucketNotEmpty', f'Bucket {bucket_name} is not empty')
+
+    def list_objects(self, bucket_name: str) -> list:
+        if not self.bucket_exists(bucket_name):
+            raise StorageError('NoSuchBucket', f'Bucket {bucket_name} does not exist')
+        # Files starting with a dot are uploads in progress
+        return [entry.name for entry in os.scandir(self.bucket_path(bucket_name)) if not entry.name.startswith('.')]
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, **kwargs):
+        path = self.object_path(bucket_name, object_name)
+        temp_path = os.path.join(os.path.dirname(path), f'.{object_name}.{uuid.uuid4().hex}')
+
+        try:
+            with open(temp_path, 'wb') as output:
+                source = file_descriptor(data)
+                if source is None:
+                    output.write(data.read() if length < 0 else data.read(length))
+                else:
+                    # The kernel copies file to file, the data never passes through Python
+                    offset = data.tell()
+                    remaining = os.fstat(source).st_size - offset if length < 0 else length
+                    position = offset
+                    while remaining > 0:
+                        sent = os.sendfile(output.fileno(), source, position, remaining)
+                        if sent == 0:
+                            break
+                        position += sent
+                        remaining -= sent
+                    data.seek(position)
+
+            # Readers see the old object or the whole new one
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def stat_object(self, bucket_name: str, object_name: str) -> ObjectStat:
+        try:
+            stat = os.stat(self.object_path(bucket_name, object_name))
+        except FileNotFoundError:
+            raise StorageError('NoSuchKey', f'Object {object_name} does not exist')
+        # Changes whenever the file is replaced, like ETags of nginx
+        return ObjectStat(stat.st_size, f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+
+    def get_object(self, bucket_name: str, object_name: str, offset: int = 0, length: int = 0) -> MappedObject:
+        try:
+            file = open(self.object_path(bucket_name, object_name), 'rb')
+        except FileNotFoundError:
+            raise StorageError('NoSuchKey', f'Object {object_name} does not exist')
+        return MappedObject(file, offset, length)
+
+    def remove_object(self, bucket_name: str, object_name: str):
+        # Removing a missing object is not an error, the same as in S3
+        try:
+            os.remove(self.object_path(bucket_name, object_name))
+        except FileNotFoundError:
+            pass
+
+    def remove_objects(self, bucket_name: str, object_names: list) -> list:
+        errors = []
+        for object_name in object_names:
+            try:
+                self.remove_object(bucket_name, object_name)
+            except (StorageError, OSError) as error:
+                errors.append(StorageError(getattr(error, 'code', 'InternalError'), str(error), object_name))
+        return errors
+
+
+class MemoryBackend(SignedUrls):
+    # Keeps objects in a dict, for tests and benchmarks without MinIO
+
+    def __init__(self):
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name: str) -> dict:
+        try:
+            return self.buckets[bucket_name]
+        except KeyError:
+            raise StorageError('NoSuchBucket', f'Bucket {bucket_name} does not exist')
+
+    def get(self, bucket_name: str, object_name: str) -> tuple:
+        try:
+            return self.bucket(bucket_name)[object_name]
+        except KeyError:
+            raise StorageError('NoSuchKey', f'Object {object_name} does not exist')
+
+    def list_buckets(self) -> list:
+        return list(self.buckets)
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return bucket_name in self.buckets
+
+    def make_bucket(self, bucket_name: str):
+        with self._lock:
+            if bucket_name in self.buckets:
+                raise StorageError('BucketAlreadyOwnedByYou', f'Bucket {bucket_name} already exists')
+            self.buckets[bucket_name] = {}
+
+    def remove_bucket(self, bucket_name: str):
+        with self._lock:
+            if self.bucket(bucket_name):
+                raise StorageError('BucketNotEmpty', f'Bucket {bucket_name} is not empty')
+            del self.buckets[bucket_name]
+
+    def list_objects(self, bucket_name: str) -> list:
+        return list(self.bucket(bucket_name))
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, **kwargs):
+        content = data.read() if length < 0 else data.read(length)
+        with self._lock:
+            self.bucket(bucket_name)[object_name] = (content, hashlib.md5(content).hexdigest())
+
+    def stat_object(self, bucket_name: str, object_name: str) -> ObjectStat:
+        content, etag = self.get(bucket_name, object_name)
+        return ObjectStat(len(content), etag)
+
+    def get_object(self, bucket_name: str, object_name: str, offset: int = 0, length: int = 0) -> io.BytesIO:
+        content, _ = self.get(bucket_name, object_name)
+        return io.BytesIO(content[offset:offset + length] if length else content[offset:])
+
+    def remove_object(self, bucket_name: str, object_name: str):
+        with self._lock:
+            self.bucket(bucket_name).pop(object_name, None)
+
+    def remove_objects(self, bucket_name: str, object_names: list) -> list:
+        for object_name in object_names:
+            self.remove_object(bucket_name, object_name)
+        return []
+
+
+def make_backend(name: str):
+    if name == 'minio':
+        return MinioBackend(minio_client)
+    if name == 'local':
+        return LocalBackend(STORAGE_PATH)
+    if name == 'memory':
+        return MemoryBackend()
+    raise ValueError(f'Unknown STORAGE_BACKEND {name}, must be minio, local or memory')
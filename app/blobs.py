@@ -0,0 +1,74 @@
+import hashlib
+
+from sqlalchemy import Integer, String, cast, column, delete, select, update, values
+from sqlalchemy.dialects.postgresql import insert
+
+from app.config import UPLOAD_CHUNK_SIZE
+from app.models import Blob
+
+
+def file_digest(file) -> str:
+    # Read in chunks, big images are spooled to disk. Blocking, run it in a thread.
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def object_key(image) -> str:
+    # Images stored before deduplication (and direct uploads) are named by their file name
+    return image.blob_key or image.file_name
+
+
+async def add_blob_references(database, bucket_name: str, references: dict) -> set:
+    # references is key -> number of new images with that content. Returns keys which were not in the bucket,
+    # their objects have to be put before the transaction is committed.
+    if not references:
+        return set()
+
+    # Rows stay locked until commit, so an upload of the same content waits and then finds the object in place.
+    # Keys are sorted to lock them in the same order in all requests.
+    query = insert(Blob).values([
+        {'bucket_name': bucket_name, 'key': key, 'ref_count': count} for key, count in sorted(references.items())
+    ])
+    query = query.on_conflict_do_update(
+        index_elements=[Blob.bucket_name, Blob.key],
+        set_={'ref_count': Blob.ref_count + query.excluded.ref_count},
+    ).returning(Blob.key, Blob.ref_count)
+
+    # Rows without references are deleted, so a count equal to the added one means the row is new
+    return {key for key, ref_count in (await database.execute(query)).all() if ref_count == references[key]}
+
+
+async def lock_blobs(database, bucket_name: str, keys: list) -> dict:
+    # Returns key -> ref_count, uploads of the same content wait until the transaction ends
+    if not keys:
+        return {}
+
+    rows = await database.execute(
+        select(Blob.key, Blob.ref_count).where(Blob.bucket_name == bucket_name, Blob.key.in_(keys)).order_by(
+            Blob.key
+        ).with_for_update()
+    )
+    return dict(rows.all())
+
+
+async def remove_blob_references(database, bucket_name: str, references: dict, ref_counts: dict):
+    # references is key -> number of removed images, ref_counts comes from lock_blobs
+    orphaned = [key for key, count in references.items() if ref_counts.get(key, 0) <= count]
+    shared = [(key, count) for key, count in references.items() if ref_counts.get(key, 0) > count]
+
+    if orphaned:
+        await database.execute(delete(Blob).where(Blob.bucket_name == bucket_name, Blob.key.in_(orphaned)))
+
+    # Decrease all counts in one statement, parameters in VALUES have no type so count is cast.
+    # Blob rows are never loaded into the session, so there is nothing to synchronize.
+    if shared:
+        removed = values(column('key', String), column('count', Integer), name='removed').data(shared)
+        await database.execute(
+            update(Blob).where(Blob.bucket_name == bucket_name, Blob.key == removed.c.key).values(
+                ref_count=Blob.ref_count - cast(removed.c.count, Integer)
+            ).execution_options(synchronize_session=False)
+        )
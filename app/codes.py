@@ -0,0 +1,51 @@
+import os
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from app.config import REQUEST_CODE_NODE_ID
+
+# Codes sent in the same millisecond by one process are counted up to this, then the next millisecond is used
+MAX_SEQUENCE = 0xffff
+
+
+def default_node_id() -> int:
+    return zlib.crc32(socket.gethostname().encode('utf8')) & 0xffffff
+
+
+class RequestCodeGenerator:
+    # Code is YYYYMMDDHHMMSSmmm + node (6 hex) + process id (6 hex) + sequence (4 hex).
+    # It starts with the upload date, which is the name of the bucket, and sorts by time across nodes.
+
+    def __init__(self, node_id: int):
+        self.node_id = node_id & 0xffffff
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last = 0
+        self._sequence = 0
+
+    def new(self) -> tuple:
+        # Returns (code, time written in the code)
+        with self._lock:
+            # Forked workers start with a copy of the parent's state
+            if self._pid != os.getpid():
+                self._pid, self._last, self._sequence = os.getpid(), 0, 0
+
+            now = time.time_ns() // 1_000_000
+            if now > self._last:
+                self._last, self._sequence = now, 0
+            else:
+                # Same millisecond or the clock went back, keep counting on the last one
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last, self._sequence = self._last + 1, 0
+
+            moment = datetime.fromtimestamp(self._last / 1000, timezone.utc)
+            code = f'{moment:%Y%m%d%H%M%S}{self._last % 1000:03d}{self.node_id:06x}{self._pid & 0xffffff:06x}' \
+                   f'{self._sequence:04x}'
+            return code, moment
+
+
+request_codes = RequestCodeGenerator(default_node_id() if REQUEST_CODE_NODE_ID is None else REQUEST_CODE_NODE_ID)
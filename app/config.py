@@ -1,7 +1,7 @@
 import os
 
 from starlette.config import Config
-from starlette.datastructures import Secret
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -10,8 +10,98 @@ config = Config(f'{dir_path[:-3]}.env')
 DATABASE_URL = f'postgresql://{config("DATABASE_USER", cast=str)}:' \
                f'{config("DATABASE_PASSWORD", cast=str)}@localhost:5432/{config("DATABASE_NAME", cast=str)}'
 
-MINIO_HOST = config('MINIO_HOST', cast=str)
-MINIO_ACCESS_KEY = config('MINIO_ACCESS_KEY', cast=str)
-MINIO_SECRET_KEY = config('MINIO_SECRET_KEY', cast=str)
+ASYNC_DATABASE_URL = DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://', 1)
+
+# Where images are kept: minio, local (files under STORAGE_PATH) or memory (lost on restart, for tests and benchmarks)
+STORAGE_BACKEND = config('STORAGE_BACKEND', cast=str, default='minio')
+STORAGE_PATH = config('STORAGE_PATH', cast=str, default=os.path.join(dir_path[:-3], 'storage'))
+# Presigned urls of local and memory storage point to the app itself, e.g. https://api.example.com
+STORAGE_PUBLIC_URL = config('STORAGE_PUBLIC_URL', cast=str, default='')
+
+MINIO_HOST = config('MINIO_HOST', cast=str, default='localhost:9000')
+MINIO_ACCESS_KEY = config('MINIO_ACCESS_KEY', cast=str, default='')
+MINIO_SECRET_KEY = config('MINIO_SECRET_KEY', cast=str, default='')
+# Known region lets the client sign URLs without asking MinIO for bucket location
+MINIO_REGION = config('MINIO_REGION', cast=str, default='us-east-1')
 
 SECRET_KEY = config('SECRET_KEY', cast=Secret)
+
+DATABASE_POOL_SIZE = config('DATABASE_POOL_SIZE', cast=int, default=5)
+DATABASE_MAX_OVERFLOW = config('DATABASE_MAX_OVERFLOW', cast=int, default=10)
+DATABASE_POOL_TIMEOUT = config('DATABASE_POOL_TIMEOUT', cast=float, default=30)
+DATABASE_POOL_RECYCLE = config('DATABASE_POOL_RECYCLE', cast=int, default=1800)
+DATABASE_POOL_PRE_PING = config('DATABASE_POOL_PRE_PING', cast=bool, default=True)
+DATABASE_POOL_SLOW_CHECKOUT = config('DATABASE_POOL_SLOW_CHECKOUT', cast=float, default=0.1)
+
+# Blocking MinIO calls run in a thread pool, this caps threads (and HTTP connections) per process
+STORAGE_THREADS = config('STORAGE_THREADS', cast=int, default=16)
+
+# How many files of one upload request are sent to MinIO at the same time
+UPLOAD_CONCURRENCY = config('UPLOAD_CONCURRENCY', cast=int, default=8)
+
+# Uploads are streamed to MinIO in parts of this size, so it bounds memory used per upload.
+# S3 does not accept parts smaller than 5 MiB.
+UPLOAD_CHUNK_SIZE = max(config('UPLOAD_CHUNK_SIZE', cast=int, default=5 * 1024 * 1024), 5 * 1024 * 1024)
+
+# Cache of auth token -> user id and group, per worker process
+AUTH_CACHE_SIZE = config('AUTH_CACHE_SIZE', cast=int, default=10000)
+AUTH_CACHE_TTL = config('AUTH_CACHE_TTL', cast=float, default=60)
+
+# Cache of request code -> list of its images, per worker process. Deleting images clears the entry only
+# on the worker which served the delete, others may return the old list for up to IMAGES_CACHE_TTL seconds.
+IMAGES_CACHE_SIZE = config('IMAGES_CACHE_SIZE', cast=int, default=10000)
+IMAGES_CACHE_TTL = config('IMAGES_CACHE_TTL', cast=float, default=300)
+
+# Algorithm for new password hashes: scrypt, pbkdf2_sha256 or sha256 (old unsalted hashes).
+# Hashes made with another algorithm or cost are replaced on successful login.
+PASSWORD_HASH_ALGORITHM = config('PASSWORD_HASH_ALGORITHM', cast=str, default='scrypt')
+PASSWORD_HASH_WORKERS = config('PASSWORD_HASH_WORKERS', cast=int, default=4)
+PBKDF2_ITERATIONS = config('PBKDF2_ITERATIONS', cast=int, default=260000)
+SCRYPT_N = config('SCRYPT_N', cast=int, default=2 ** 14)
+SCRYPT_R = config('SCRYPT_R', cast=int, default=8)
+SCRYPT_P = config('SCRYPT_P', cast=int, default=1)
+
+# Seconds before midnight UTC when the next day's bucket is created
+BUCKET_PROVISION_LEAD = config('BUCKET_PROVISION_LEAD', cast=int, default=600)
+
+# Images are sent to clients in chunks of this size
+DOWNLOAD_CHUNK_SIZE = config('DOWNLOAD_CHUNK_SIZE', cast=int, default=256 * 1024)
+
+# Lifetime of presigned image URLs, they are cached and reused until PRESIGN_REFRESH_MARGIN seconds before expiry
+PRESIGN_EXPIRY = config('PRESIGN_EXPIRY', cast=int, default=900)
+PRESIGN_REFRESH_MARGIN = config('PRESIGN_REFRESH_MARGIN', cast=int, default=60)
+PRESIGN_CACHE_SIZE = config('PRESIGN_CACHE_SIZE', cast=int, default=10000)
+
+# Presigned upload urls live this long, uploads which are not committed are removed after PENDING_UPLOAD_TTL
+PRESIGN_UPLOAD_EXPIRY = config('PRESIGN_UPLOAD_EXPIRY', cast=int, default=900)
+PENDING_UPLOAD_TTL = config('PENDING_UPLOAD_TTL', cast=int, default=3600)
+PENDING_UPLOAD_GC_INTERVAL = config('PENDING_UPLOAD_GC_INTERVAL', cast=int, default=300)
+
+# Every uploaded image gets smaller copies which fit into these sizes (px), made by a pool of worker processes
+DERIVATIVE_SIZES = [int(size) for size in config('DERIVATIVE_SIZES', cast=CommaSeparatedStrings, default='128,512')]
+DERIVATIVE_QUALITY = config('DERIVATIVE_QUALITY', cast=int, default=80)
+DERIVATIVE_WORKERS = config('DERIVATIVE_WORKERS', cast=int, default=2)
+DERIVATIVE_QUEUE_SIZE = config('DERIVATIVE_QUEUE_SIZE', cast=int, default=1000)
+
+# Id of this node in request codes (0 - 16777215), it must differ between nodes.
+# Without it the id is taken from the host name, which is enough while nodes have different names.
+REQUEST_CODE_NODE_ID = config('REQUEST_CODE_NODE_ID', cast=int, default=None)
+
+# Days after which images are removed together with their inbox partition and bucket, 0 keeps them forever.
+# Partitions for today and tomorrow are also checked every RETENTION_INTERVAL seconds.
+INBOX_RETENTION_DAYS = config('INBOX_RETENTION_DAYS', cast=int, default=0)
+RETENTION_INTERVAL = config('RETENTION_INTERVAL', cast=int, default=3600)
+
+# Add Server-Timing header with database and storage time to every response, Prometheus metrics are on /metrics
+SERVER_TIMING = config('SERVER_TIMING', cast=bool, default=False)
+
+# Images of a tar or zip archive are saved in batches of this size, each with one commit and progress update
+INGEST_BATCH_SIZE = config('INGEST_BATCH_SIZE', cast=int, default=100)
+
+# Uploads with ?background=true are written under INGEST_SPOOL_PATH and saved by INGEST_WORKERS tasks per worker
+# process. New ones are refused with 503 while INGEST_QUEUE_SIZE uploads wait. Failed saves are tried
+# INGEST_RETRIES times, the spool is left for the next start after that.
+INGEST_SPOOL_PATH = config('INGEST_SPOOL_PATH', cast=str, default=os.path.join(dir_path[:-3], 'spool'))
+INGEST_WORKERS = config('INGEST_WORKERS', cast=int, default=4)
+INGEST_QUEUE_SIZE = config('INGEST_QUEUE_SIZE', cast=int, default=1000)
+INGEST_RETRIES = config('INGEST_RETRIES', cast=int, default=3)
@@ -13,3 +13,7 @@ class UserCreateForm(BaseModel):
     first_name: Optional[str] = None
     last_name: Optional[str] = None
     nickname: Optional[str] = None
+
+
+class UploadInitiateForm(BaseModel):
+    count: int
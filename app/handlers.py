@@ -1,16 +1,137 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import os
+import tempfile
 import uuid
-from datetime import datetime
-from io import BytesIO
-
-from fastapi import APIRouter, Body, Depends, HTTPException, UploadFile, File
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, Response, UploadFile, File
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import delete, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
 from starlette import status
-
-from app.forms import UserLoginForm, UserCreateForm
-from app.models import connect_db, minio_client, User, AuthToken, Inbox
-from app.utils import get_password_hash
+from starlette.concurrency import run_in_threadpool
+
+from app.archives import ArchiveError, ingest_archive
+from app.backends import StorageError, check_signature
+from app.blobs import add_blob_references, file_digest, lock_blobs, object_key, remove_blob_references
+from app.auth import TokenOwner, get_staff_owner, get_token_owner, token_cache
+from app.cache import TTLCache
+from app.codes import request_codes
+from app.config import UPLOAD_CONCURRENCY, UPLOAD_CHUNK_SIZE, DERIVATIVE_SIZES, IMAGES_CACHE_SIZE, IMAGES_CACHE_TTL, \
+    PENDING_UPLOAD_TTL
+from app.ingest import ingest_queue
+from app.forms import UserLoginForm, UserCreateForm, UploadInitiateForm
+from app.models import connect_db, User, AuthToken, Inbox, Ingest, PendingUpload
+from app.storage import daily_bucket_name, storage
+from app.thumbnails import derivative_name, derivative_queue
+from app.utils import hash_password, verify_password
 
 router = APIRouter()
 
+# Images of a request code don't change until they are deleted, so get_images answers from memory.
+# Values are (etag, list of images).
+images_cache = TTLCache(IMAGES_CACHE_SIZE, IMAGES_CACHE_TTL)
+
+
+def format_time(moment: datetime) -> str:
+    # Times are returned to clients in UTC without fractions of a second
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def encode_cursor(created_at: datetime, request_code: str) -> str:
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{request_code}'.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, request_code = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8').split('|', 1)
+        return datetime.fromisoformat(created_at), request_code
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+
+def as_utc(moment: Optional[datetime]) -> Optional[datetime]:
+    # Times without time zone given by clients are in UTC
+    if moment is None or moment.tzinfo is not None:
+        return moment
+    return moment.replace(tzinfo=timezone.utc)
+
+
+def upload_file_size(file: UploadFile) -> int:
+    # UploadFile is already spooled to a temp file, so its size is known without reading it
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+async def object_response(request: Request, bucket_name: str, object_name: str) -> Response:
+    # Streams an object from storage, answers If-None-Match and single Range requests
+    stat = await storage.stat_object(bucket_name, object_name)
+    headers = {'ETag': f'"{stat.etag}"', 'Accept-Ranges': 'bytes'}
+
+    # Client already has this version of the object
+    if etag_matches(request.headers.get('if-none-match'), stat.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Send only the requested part of the object
+    byte_range = parse_range(request.headers.get('range'), stat.size)
+    if byte_range:
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{stat.size}'
+        headers['Content-Length'] = str(end - start + 1)
+        return StreamingResponse(storage.stream_object(bucket_name, object_name, start, end - start + 1),
+                                 status_code=status.HTTP_206_PARTIAL_CONTENT, media_type='image/jpeg',
+                                 headers=headers)
+
+    headers['Content-Length'] = str(stat.size)
+    return StreamingResponse(storage.stream_object(bucket_name, object_name), media_type='image/jpeg',
+                             headers=headers)
+
+
+def ingest_status(ingest: Ingest) -> dict:
+    return {'request_code': ingest.request_code, 'status': ingest.status, 'stored': ingest.stored,
+            'skipped': ingest.skipped, 'error': ingest.error, 'created_at': format_time(ingest.created_at),
+            'updated_at': format_time(ingest.updated_at)}
+
+
+def images_etag(code: str, images: list) -> str:
+    return hashlib.sha256(json.dumps([code, images], sort_keys=True).encode('utf8')).hexdigest()
+
+
+def parse_range(range_header: str, size: int):
+    # Only a single "bytes=start-end" range is supported, anything else gets the whole image
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+
+    start, _, end = range_header[len('bytes='):].strip().partition('-')
+    try:
+        if start:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        else:
+            # "bytes=-500" means the last 500 bytes
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        return None
+
+    if start > end or start >= size:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            detail='Requested range not satisfiable', headers={'Content-Range': f'bytes */{size}'})
+    return start, end
+
 
 @router.get('/')
 def read_root():
@@ -18,10 +139,10 @@ def read_root():
 
 
 @router.post('/user', name='Create User')
-def create_user(user: UserCreateForm = Body(..., embed=True), database=Depends(connect_db)):
+async def create_user(user: UserCreateForm = Body(..., embed=True), database=Depends(connect_db)):
 
     # Check if user exist
-    exists_user = database.query(User.id).filter(User.email == user.email).one_or_none()
+    exists_user = (await database.execute(select(User.id).where(User.email == user.email))).scalar_one_or_none()
 
     # If user exist raise exception
     if exists_user:
@@ -35,70 +156,72 @@ def create_user(user: UserCreateForm = Body(..., embed=True), database=Depends(c
     else:
         group = 'user'
 
-    # Create new user
-    new_user = User(
+    # Create new user, a signup with the same email which got in since the check makes it return no row
+    user_id = (await database.execute(insert(User).values(
         email=user.email,
         group=group,
-        password=get_password_hash(user.password),
+        password=await hash_password(user.password),
         first_name=user.first_name,
         last_name=user.last_name,
         nickname=user.nickname,
-    )
+    ).on_conflict_do_nothing(index_elements=[User.email]).returning(User.id))).scalar_one_or_none()
+
+    if user_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Email already exists')
 
     # Commit new user in db
-    database.add(new_user)
-    database.commit()
+    await database.commit()
 
     # Return user id
-    return {'User id': new_user.id}
+    return {'User id': user_id}
 
 
 @router.post('/login', name='Login User')
-def user_login(user_form: UserLoginForm = Body(..., embed=True), database=Depends(connect_db)):
+async def user_login(user_form: UserLoginForm = Body(..., embed=True), database=Depends(connect_db)):
 
-    # Get user from db
-    user = database.query(User).filter(User.email == user_form.email).one_or_none()
+    # Get from db only columns needed to check user. The row is locked until commit, so logins of one user run
+    # one after another and each one sees the token of the previous one (FOR NO KEY UPDATE lets the token keep
+    # referencing the user).
+    user = (await database.execute(
+        select(User.id, User.password).where(User.email == user_form.email).with_for_update(key_share=True)
+    )).one_or_none()
+
+    # Check password outside of the event loop, unknown emails take as long as wrong passwords
+    valid, needs_rehash = await verify_password(user_form.password, user.password if user else None)
 
     # If input data incorrect raise exception
-    if not user or get_password_hash(user_form.password) != user.password:
+    if not valid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Email/password invalid')
 
-    # Check if token for user exist
-    if not database.query(AuthToken).filter(AuthToken.user_id == user.id).one_or_none():
-
-        # If token not exist, create new token
-        auth_token = AuthToken(token=str(uuid.uuid4()), user_id=user.id)
-        database.add(auth_token)
-
-        database.commit()
-    else:
+    # Replace old password hash with one made by current algorithm
+    if needs_rehash:
+        await database.execute(
+            update(User).where(User.id == user.id).values(password=await hash_password(user_form.password))
+        )
 
-        # If token already exist, update it
-        auth_token = database.query(AuthToken).filter(AuthToken.user_id == user.id).one_or_none()
-        database.query(AuthToken).filter(AuthToken.user_id == user.id).update({AuthToken.token: str(uuid.uuid4()),
-                                                                               AuthToken.created_at: datetime.utcnow()})
-        database.commit()
+    # Create token or replace the existing one in a single statement,
+    # the subquery sees the row as it was before the statement, so it returns the old token.
+    # Other worker processes keep accepting the old token for up to AUTH_CACHE_TTL, see app/auth.py.
+    old_token = select(AuthToken.token).where(AuthToken.user_id == user.id).scalar_subquery()
+    query = insert(AuthToken).values(token=str(uuid.uuid4()), user_id=user.id, created_at=func.now())
+    query = query.on_conflict_do_update(
+        index_elements=[AuthToken.user_id],
+        set_={'token': query.excluded.token, 'created_at': query.excluded.created_at},
+    ).returning(AuthToken.token, old_token.label('old_token'))
+    auth_token = (await database.execute(query)).one()
+    await database.commit()
+
+    # Forget the old token
+    if auth_token.old_token:
+        token_cache.pop(auth_token.old_token)
 
     # Return token to user
     return {'Auth Token': auth_token.token}
 
 
 @router.post('/frames/{auth_token}', name='Upload images')
-async def upload_images(auth_token: str, files: list[UploadFile] = File(...), database=Depends(connect_db)):
-
-    # Get user token from db
-    auth_token_column = database.query(AuthToken).filter(AuthToken.token == auth_token).one_or_none()
-
-    # Checking if the token exist
-    if auth_token_column is None:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='AuthToken dont exist')
-    else:
-        # If token exist check user group
-        user_column = database.query(User).filter(User.id == auth_token_column.user_id).one_or_none()
-
-        # If user group not admin/moderator raise exception
-        if user_column.group not in ['admin', 'moderator']:
-            raise HTTPException(status_code=status.HTTP_405_METHOD_NOT_ALLOWED, detail='You must be admin/moderator')
+async def upload_images(files: list[UploadFile] = File(...), background: bool = False,
+                        owner: TokenOwner = Depends(get_staff_owner), database=Depends(connect_db)):
 
     # Check count of files
     if len(files) > 15 or len(files) == 0:
@@ -108,18 +231,43 @@ async def upload_images(auth_token: str, files: list[UploadFile] = File(...), da
     if not all([True if file.filename.endswith('.jpg') else False for file in files]):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='All images must be in format .jpg')
 
+    # Background uploads wait on local disk, don't take more than the workers can catch up with
+    if background and ingest_queue.full():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Upload queue is full')
+
     # Preparing important values
-    request_code = str(datetime.utcnow()).replace(':', '').replace('-', '').replace(' ', '').replace('.', '')[:-6]
-    date = str(datetime.utcnow())[:-7]
-    bucket_name = str(datetime.utcnow())[:10].replace('-', '')
+    # Code, time and bucket all come from one reading of the clock
+    request_code, created_at = request_codes.new()
+    date = format_time(created_at)
+    bucket_name = daily_bucket_name(created_at)
     response = {request_code: []}
 
+    # Answer as soon as the images are on local disk, they are saved to MinIO and db in background
+    if background:
+        file_names = await ingest_queue.spool(request_code, created_at, owner.user_id, [file.file for file in files])
+        try:
+            database.add(Ingest(request_code=request_code, user_id=owner.user_id, status='queued', stored=0,
+                                skipped=0))
+            await database.commit()
+        except Exception:
+            # The client gets an error, so the upload is not saved later
+            ingest_queue.discard(request_code)
+            raise
+        ingest_queue.enqueue(request_code)
+
+        # Progress is on /frames/auth_token/code/status
+        response[request_code] = [{'file_name': file_name, 'created_at': date} for file_name in file_names]
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=response)
+
     # Check bucket exist
-    if not minio_client.bucket_exists(bucket_name):
-        minio_client.make_bucket(bucket_name)
+    await storage.ensure_bucket(bucket_name)
+
+    # Hash the spooled files in threads, images are stored under the hash of their content
+    keys = await asyncio.gather(*[run_in_threadpool(file_digest, file.file) for file in files])
 
-    # Upload images to DB and MinIO
-    for file in files:
+    # Prepare data for DB and MinIO
+    uploads = {}
+    for file, key in zip(files, keys):
         # Create file_name
         file_name = str(uuid.uuid4())
 
@@ -127,15 +275,12 @@ async def upload_images(auth_token: str, files: list[UploadFile] = File(...), da
         new_image = Inbox(
             request_code=request_code,
             file_name=file_name,
-            created_at=date
+            created_at=created_at,
+            blob_key=key,
         )
 
-        # Upload images to MinIO
-        minio_client.put_object(bucket_name=bucket_name, object_name=file_name + '.jpg',
-                                data=BytesIO(bytes(await file.read())),
-                                length=-1,
-                                part_size=10 * 1024 * 1024
-                                )
+        # Preparing image for MinIO, the spooled file is streamed as is. Same images of a request are put once.
+        uploads[key] = (key + '.jpg', file.file, upload_file_size(file))
 
         # Preparing data to db
         database.add(new_image)
@@ -143,52 +288,306 @@ async def upload_images(auth_token: str, files: list[UploadFile] = File(...), da
         # Preparing response for user
         response[request_code].append({'file_name': file_name, 'created_at': date})
 
-    database.commit()
+    # Only images which are not in the bucket yet are uploaded, others get one more reference
+    new_keys = await add_blob_references(database, bucket_name, Counter(keys))
+
+    # Upload images to MinIO in parallel
+    await storage.put_objects(bucket_name, [uploads[key] for key in new_keys], UPLOAD_CONCURRENCY,
+                              part_size=UPLOAD_CHUNK_SIZE, num_parallel_uploads=1)
+
+    await database.commit()
+
+    # Make smaller copies of new images in background
+    for key in new_keys:
+        derivative_queue.enqueue(bucket_name, key)
 
     # Return data about created images
     return response
 
 
-@router.get('/frames/{auth_token}/{code}', name='Get images by request code')
-def get_images(auth_token: str, code: str, database=Depends(connect_db)):
+@router.post('/frames/{auth_token}/initiate', name='Start direct upload to MinIO')
+async def initiate_upload(upload: UploadInitiateForm = Body(..., embed=True),
+                          owner: TokenOwner = Depends(get_staff_owner), database=Depends(connect_db)):
 
-    # Get user token from db
-    auth_token_column = database.query(AuthToken).filter(AuthToken.token == auth_token).one_or_none()
+    # Check count of files
+    if upload.count > 15 or upload.count <= 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Count of images must be 1-15')
 
-    # Checking if the token exist
-    if auth_token_column is None:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='AuthToken dont exist')
+    # Preparing important values
+    request_code, created_at = request_codes.new()
+    bucket_name = daily_bucket_name(created_at)
+    response = {request_code: []}
 
-    # Get images from db
-    images = database.query(Inbox).filter(Inbox.request_code == code).all()
+    # Check bucket exist
+    await storage.ensure_bucket(bucket_name)
 
-    # Checking if the request code exist
-    if not images:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Images with code {code} doesnt exist')
+    for _ in range(upload.count):
+        file_name = str(uuid.uuid4())
+
+        # Remember the upload until it is committed
+        database.add(PendingUpload(request_code=request_code, file_name=file_name, user_id=owner.user_id))
+
+        # Give client a url to put the image straight to MinIO
+        response[request_code].append({
+            'file_name': file_name,
+            'url': storage.presigned_put_url(bucket_name, file_name + '.jpg'),
+        })
+
+    await database.commit()
+
+    # Return urls for upload
+    return response
+
+
+@router.post('/frames/{auth_token}/{code}/commit', name='Finish direct upload to MinIO')
+async def commit_upload(code: str, owner: TokenOwner = Depends(get_staff_owner), database=Depends(connect_db)):
+
+    # Get started upload from db, locked so the collector skips it and a second commit waits until this one ends
+    pending = (await database.execute(
+        select(PendingUpload).where(PendingUpload.request_code == code).with_for_update()
+    )).scalars().all()
+
+    # Checking if the upload exist
+    if not pending:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Upload with code {code} doesnt exist')
+
+    # Other staff members can't commit it
+    if any(upload.user_id != owner.user_id for upload in pending):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f'Upload with code {code} was started by another user')
+
+    # The collector may have removed objects of an expired upload already
+    expired_before = datetime.now(timezone.utc) - timedelta(seconds=PENDING_UPLOAD_TTL)
+    if any(upload.created_at < expired_before for upload in pending):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Upload with code {code} is expired')
+
+    # Check all images are in MinIO
+    stats = await storage.stat_objects(code[:8], [upload.file_name + '.jpg' for upload in pending],
+                                       UPLOAD_CONCURRENCY)
+    missing = [upload.file_name for upload in pending if stats[upload.file_name + '.jpg'] is None]
+    if missing:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Images {", ".join(missing)} are not uploaded')
+
+    # Save images in one statement and forget the started upload
+    created_at = datetime.now(timezone.utc)
+    await database.execute(insert(Inbox).values([
+        {'request_code': code, 'file_name': upload.file_name, 'created_at': created_at} for upload in pending
+    ]))
+    await database.execute(delete(PendingUpload).where(PendingUpload.request_code == code))
+    await database.commit()
+    images_cache.pop(code)
+
+    # Make smaller copies of images in background
+    for upload in pending:
+        derivative_queue.enqueue(code[:8], upload.file_name)
+
+    # Return data about created images
+    return {code: [{'file_name': upload.file_name, 'created_at': format_time(created_at)} for upload in pending]}
+
+
+@router.post('/frames/{auth_token}/archive', name='Upload images in a tar or zip archive')
+async def upload_archive(request: Request, owner: TokenOwner = Depends(get_staff_owner),
+                         database=Depends(connect_db)):
+
+    # All images of the archive get one request code
+    request_code, created_at = request_codes.new()
+
+    # Images are read from the body as it arrives and saved in batches
+    try:
+        ingest = await ingest_archive(request.stream(), database, owner.user_id, request_code, created_at)
+    except ArchiveError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Archive of request code {request_code} is broken: {error}')
+
+    # Return count of saved and skipped files
+    return ingest_status(ingest)
+
+
+@router.get('/frames/{auth_token}/archive', name='List archive uploads')
+async def list_archives(owner: TokenOwner = Depends(get_staff_owner), database=Depends(connect_db)):
+
+    # Latest uploads of the user, running ones show progress
+    ingests = (await database.execute(
+        select(Ingest).where(Ingest.user_id == owner.user_id).order_by(Ingest.request_code.desc()).limit(100)
+    )).scalars().all()
+
+    return {'archives': [ingest_status(ingest) for ingest in ingests]}
+
+
+@router.get('/frames/{auth_token}/archive/{code}', name='Progress of archive upload')
+async def get_archive(code: str, owner: TokenOwner = Depends(get_staff_owner), database=Depends(connect_db)):
+
+    ingest = (await database.execute(select(Ingest).where(Ingest.request_code == code))).scalar_one_or_none()
+
+    # Checking if the upload exist
+    if ingest is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Archive with code {code} doesnt exist')
+
+    return ingest_status(ingest)
+
+
+@router.get('/frames/{auth_token}', name='List request codes by upload time')
+async def list_codes(from_: Optional[datetime] = Query(None, alias='from'), to: Optional[datetime] = None,
+                     after: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+                     owner: TokenOwner = Depends(get_token_owner), database=Depends(connect_db)):
+
+    # Codes in the time range, in upload order, each with count of its images
+    query = select(Inbox.created_at, Inbox.request_code, func.count().label('images')).group_by(
+        Inbox.created_at, Inbox.request_code
+    ).order_by(Inbox.created_at, Inbox.request_code).limit(limit)
+    if from_ is not None:
+        query = query.where(Inbox.created_at >= as_utc(from_))
+    if to is not None:
+        query = query.where(Inbox.created_at < as_utc(to))
+
+    # Continue right after the last code of the previous page, so no rows are skipped by OFFSET
+    if after:
+        query = query.where(tuple_(Inbox.created_at, Inbox.request_code) > decode_cursor(after))
+
+    codes = (await database.execute(query)).all()
+
+    # Cursor of the next page, none when this page is the last one
+    cursor = encode_cursor(codes[-1].created_at, codes[-1].request_code) if len(codes) == limit else None
+
+    return {
+        'codes': [{'request_code': code.request_code, 'created_at': format_time(code.created_at),
+                   'images': code.images} for code in codes],
+        'after': cursor,
+    }
+
+
+@router.get('/frames/{auth_token}/{code}', name='Get images by request code')
+async def get_images(code: str, request: Request, response: Response, presign: bool = False,
+                     owner: TokenOwner = Depends(get_token_owner), database=Depends(connect_db)):
+
+    # Get images from cache or db
+    cached = images_cache.get(code)
+    if cached is None:
+        # With the status of the code's ingest, if it was uploaded in background or as an archive
+        rows = (await database.execute(
+            select(Inbox, Ingest.status).outerjoin(Ingest, Ingest.request_code == Inbox.request_code).where(
+                Inbox.request_code == code
+            )
+        )).all()
+
+        # Checking if the request code exist
+        if not rows:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f'Images with code {code} doesnt exist')
+
+        # Prepare the images corresponding to the code, with sizes of their smaller copies
+        objects = [object_key(row.Inbox) for row in rows]
+        images = [{'file_name': row.Inbox.file_name, 'created_at': format_time(row.Inbox.created_at),
+                   'sizes': DERIVATIVE_SIZES} for row in rows]
+        cached = images_etag(code, images), images, objects
+
+        # Images of an ingest which is not done yet are still being added, the list is read again next time
+        if rows[0].status in [None, 'done']:
+            images_cache.set(code, cached)
+    etag, images, objects = cached
+
+    # Add short-lived links, so clients download images straight from MinIO.
+    # Links change over time, so such responses have no ETag.
+    if presign:
+        return {code: [{**image, 'url': storage.presigned_get_url(code[:8], key + '.jpg')}
+                       for image, key in zip(images, objects)]}
+
+    # Client already has this list of images
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': f'"{etag}"'})
 
     # Return the images corresponding to the code
-    return {code: [{'file_name': image.file_name, 'created_at': image.created_at} for image in images]}
+    response.headers['ETag'] = f'"{etag}"'
+    return {code: images}
 
 
-@router.delete('/frames/{auth_token}/{code}', name='Delete images from DB and MinIO')
-def delete_images(auth_token: str, code: str, database=Depends(connect_db)):
+@router.get('/frames/{auth_token}/{code}/status', name='Progress of upload in background')
+async def get_upload_status(code: str, owner: TokenOwner = Depends(get_token_owner), database=Depends(connect_db)):
 
-    # Get user token from db
-    auth_token_column = database.query(AuthToken).filter(AuthToken.token == auth_token).one_or_none()
+    ingest = (await database.execute(select(Ingest).where(Ingest.request_code == code))).scalar_one_or_none()
 
-    # Checking if the token exist
-    if auth_token_column is None:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='AuthToken dont exist')
-    else:
-        # If token exist check user group
-        user_column = database.query(User).filter(User.id == auth_token_column.user_id).one_or_none()
+    # Checking if the upload exist
+    if ingest is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Upload with code {code} doesnt exist')
+
+    return ingest_status(ingest)
+
+
+@router.get('/frames/{auth_token}/{code}/{file_name}', name='Download image')
+async def download_image(code: str, file_name: str, request: Request, size: Optional[int] = None,
+                         owner: TokenOwner = Depends(get_token_owner), database=Depends(connect_db)):
+
+    # Check the size is one of smaller copies
+    if size is not None and size not in DERIVATIVE_SIZES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Size must be one of {", ".join(map(str, DERIVATIVE_SIZES))}')
+
+    # Check the image belongs to the request code
+    image = (await database.execute(
+        select(Inbox.file_name, Inbox.blob_key).where(Inbox.file_name == file_name, Inbox.request_code == code)
+    )).one_or_none()
+
+    # Release the db connection, it is not needed while the image is sent
+    await database.close()
+
+    if image is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Image {file_name} with code {code} doesnt exist')
 
-        # If user group not admin/moderator raise exception
-        if user_column.group not in ['admin', 'moderator']:
-            raise HTTPException(status_code=status.HTTP_405_METHOD_NOT_ALLOWED, detail='You must be admin/moderator')
+    # Get size and ETag of the image
+    key = object_key(image)
+    object_name = (key if size is None else derivative_name(key, size)) + '.jpg'
+    try:
+        return await object_response(request, code[:8], object_name)
+    except StorageError as error:
+        # Smaller copies are made in background and may be not ready yet, or were skipped on a full queue
+        if size is None or error.code != 'NoSuchKey':
+            raise
+        derivative_queue.enqueue(code[:8], key)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Image {file_name} of size {size} is not ready')
+
+
+@router.get('/storage/{bucket_name}/{object_name}', name='Download by presigned url')
+async def get_stored_object(bucket_name: str, object_name: str, expires: int, signature: str, request: Request):
+
+    # Urls are signed by local and memory storage instead of MinIO
+    if not check_signature('GET', bucket_name, object_name, expires, signature):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Url is invalid or expired')
+
+    try:
+        return await object_response(request, bucket_name, object_name)
+    except StorageError as error:
+        if error.code not in ['NoSuchKey', 'NoSuchBucket']:
+            raise
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'{object_name} doesnt exist')
+
+
+@router.put('/storage/{bucket_name}/{object_name}', name='Upload by presigned url')
+async def put_stored_object(bucket_name: str, object_name: str, expires: int, signature: str, request: Request):
+
+    if not check_signature('PUT', bucket_name, object_name, expires, signature):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Url is invalid or expired')
+
+    # Spool the body the same way as multipart uploads, big images go to disk
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as file:
+        async for chunk in request.stream():
+            file.write(chunk)
+        size = file.tell()
+        file.seek(0)
+
+        await storage.ensure_bucket(bucket_name)
+        await storage.put_object(bucket_name, object_name, file, size)
+
+    return Response(status_code=status.HTTP_200_OK)
+
+
+@router.delete('/frames/{auth_token}/{code}', name='Delete images from DB and MinIO')
+async def delete_images(code: str, owner: TokenOwner = Depends(get_staff_owner), database=Depends(connect_db)):
 
     # Get images from db
-    images = database.query(Inbox).filter(Inbox.request_code == code).all()
+    images = (await database.execute(select(Inbox).where(Inbox.request_code == code))).scalars().all()
 
     # Checking if the request code exist
     if not images:
@@ -197,13 +596,43 @@ def delete_images(auth_token: str, code: str, database=Depends(connect_db)):
     # Create bucket name from date when images was created
     bucket_name = images[0].request_code[:8]
 
-    # Remove images from MinIO
-    for image in images:
-        minio_client.remove_object(bucket_name, image.file_name + '.jpg')
-
-    # Remove data about images from db
-    database.query(Inbox).filter(Inbox.request_code == code).delete()
-    database.commit()
+    # Lock shared images, objects referenced only by this code are removed with it
+    references = Counter(image.blob_key for image in images if image.blob_key)
+    ref_counts = await lock_blobs(database, bucket_name, list(references))
+    removed_keys = {object_key(image) for image in images
+                    if not image.blob_key or ref_counts.get(image.blob_key, 0) <= references[image.blob_key]}
+
+    # Images and their smaller copies
+    objects = {}
+    for key in removed_keys:
+        objects[key + '.jpg'] = key
+        for size in DERIVATIVE_SIZES:
+            objects[derivative_name(key, size) + '.jpg'] = key
+
+    # Remove images from MinIO in batches
+    errors = await storage.remove_objects(bucket_name, list(objects))
+    failed_keys = {objects[error.name] for error in errors}
+    failed = [image.file_name for image in images if object_key(image) in failed_keys]
+
+    # Remove data about images from db, rows of images which are still in MinIO stay
+    query = delete(Inbox).where(Inbox.request_code == code)
+    if failed:
+        query = query.where(Inbox.file_name.notin_(failed))
+    await database.execute(query)
+    await remove_blob_references(database, bucket_name,
+                                 {key: count for key, count in references.items() if key not in failed_keys},
+                                 ref_counts)
+    await database.commit()
+    images_cache.pop(code)
+
+    # Return images which could not be deleted
+    if errors:
+        return JSONResponse(status_code=status.HTTP_207_MULTI_STATUS, content={
+            'detail': f'Images with code {code} was partially deleted',
+            'errors': [{'file_name': image.file_name, 'object_name': error.name, 'code': error.code,
+                        'message': error.message}
+                       for error in errors for image in images if object_key(image) == objects[error.name]],
+        })
 
     # Return code of deleted images if successfully
     return f'Images with code {code} was deleted'
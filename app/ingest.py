@@ -0,0 +1,230 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from sqlalchemy import func, insert, update
+from starlette.concurrency import run_in_threadpool
+
+from app.blobs import add_blob_references
+from app.config import INGEST_SPOOL_PATH, INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_RETRIES, DOWNLOAD_CHUNK_SIZE, \
+    UPLOAD_CHUNK_SIZE, UPLOAD_CONCURRENCY
+from app.models import AsyncSessionLocal, Inbox, Ingest
+from app.storage import daily_bucket_name, storage
+from app.thumbnails import derivative_queue
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+# Spool directories without manifest are left by a process which stopped while writing them
+STALE_SPOOL_AGE = 3600
+
+# Image ready to be saved: its file is open at the start and key is the sha256 of its content
+SpooledImage = namedtuple('SpooledImage', ['file_name', 'file', 'key', 'size'])
+
+
+async def store_images(database, request_code: str, created_at: datetime, images: list, skipped: int = 0,
+                       **progress) -> set:
+    # References of the content, new objects, rows of the images and progress of the ingest, without commit.
+    # Returns keys of new objects, their smaller copies are made after commit.
+    bucket_name = daily_bucket_name(created_at)
+
+    new_keys = await add_blob_references(database, bucket_name, Counter(image.key for image in images))
+    uploads = {image.key: (image.key + '.jpg', image.file, image.size) for image in images if image.key in new_keys}
+    await storage.put_objects(bucket_name, list(uploads.values()), UPLOAD_CONCURRENCY,
+                              part_size=UPLOAD_CHUNK_SIZE, num_parallel_uploads=1)
+
+    if images:
+        await database.execute(insert(Inbox).values([
+            {'request_code': request_code, 'file_name': image.file_name, 'created_at': created_at,
+             'blob_key': image.key} for image in images
+        ]))
+    await database.execute(update(Ingest).where(Ingest.request_code == request_code).values(
+        stored=Ingest.stored + len(images), skipped=Ingest.skipped + skipped, updated_at=func.now(), **progress
+    ))
+    return new_keys
+
+
+def spool_file(source, path: str) -> str:
+    # Copy an uploaded file to the spool, hashing it on the way. Blocking, run it in a thread.
+    digest = hashlib.sha256()
+    source.seek(0)
+    with open(path, 'wb') as file:
+        for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            file.write(chunk)
+    return digest.hexdigest()
+
+
+def write_manifest(directory: str, manifest: dict):
+    # The manifest is written last and renamed into place, directories without it were not accepted
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(path + '.tmp', path)
+
+
+class IngestQueue:
+
+    def __init__(self, path: str, workers: int, maxsize: int, retries: int):
+        self.path = path
+        self.workers = workers
+        self.maxsize = maxsize
+        self.retries = retries
+        self._queue = None
+        self._tasks = []
+
+    async def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+        # Uploads accepted before a restart are saved again
+        for request_code in sorted(os.listdir(self.path)):
+            directory = os.path.join(self.path, request_code)
+            if os.path.exists(os.path.join(directory, MANIFEST)):
+                self._queue.put_nowait(request_code)
+            elif time.time() - os.path.getmtime(directory) > STALE_SPOOL_AGE:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._queue = None
+
+    def full(self) -> bool:
+        return self._queue is None or self._queue.qsize() >= self.maxsize
+
+    async def spool(self, request_code: str, created_at: datetime, user_id: int, files: list) -> list:
+        # Write uploaded files to local disk, returns names of the images
+        directory = os.path.join(self.path, request_code)
+        os.makedirs(directory)
+
+        file_names = [str(uuid.uuid4()) for _ in files]
+        try:
+            keys = await asyncio.gather(*[
+                run_in_threadpool(spool_file, file, os.path.join(directory, file_name + '.jpg'))
+                for file, file_name in zip(files, file_names)
+            ])
+
+            write_manifest(directory, {
+                'request_code': request_code,
+                'created_at': created_at.isoformat(),
+                'user_id': user_id,
+                'images': [{'file_name': file_name, 'key': key} for file_name, key in zip(file_names, keys)],
+            })
+        except Exception:
+            self.discard(request_code)
+            raise
+        return file_names
+
+    def discard(self, request_code: str):
+        # Spooled upload which was not accepted, it must not be saved on the next start
+        shutil.rmtree(os.path.join(self.path, request_code), ignore_errors=True)
+
+    def enqueue(self, request_code: str):
+        if self._queue is not None:
+            self._queue.put_nowait(request_code)
+
+    async def run(self):
+        # stop() drops the queue while this task is being cancelled
+        queue = self._queue
+        while True:
+            request_code = await queue.get()
+            try:
+                await self.process(request_code)
+            except Exception:
+                logger.exception('Could not save upload %s, it is tried again on next start', request_code)
+            finally:
+                queue.task_done()
+
+    async def process(self, request_code: str):
+        directory = os.path.join(self.path, request_code)
+        try:
+            manifest_file = open(os.path.join(directory, MANIFEST))
+        except FileNotFoundError:
+            # Saved by another worker process
+            return
+
+        with manifest_file:
+            # Every worker process replays the spool on start, the lock keeps an upload to one of them.
+            # It is released when the process dies, so a crashed save is picked up on the next start.
+            try:
+                fcntl.flock(manifest_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            if os.fstat(manifest_file.fileno()).st_nlink == 0:
+                return
+
+            manifest = json.load(manifest_file)
+            for attempt in range(1, self.retries + 1):
+                try:
+                    await self.save(manifest, directory)
+                    break
+                except Exception as error:
+                    # Clients see the error while it is tried again
+                    last = attempt == self.retries
+                    await self.set_status(request_code, 'failed' if last else 'running',
+                                          str(error) or type(error).__name__)
+                    if last:
+                        raise
+                    logger.warning('Could not save upload %s (attempt %s): %s', request_code, attempt, error)
+                    await asyncio.sleep(2 ** attempt)
+
+            # Unlinked before the lock is released, so no other process saves it again
+            os.unlink(os.path.join(directory, MANIFEST))
+        shutil.rmtree(directory, ignore_errors=True)
+
+    async def set_status(self, request_code: str, status: str, error: str = None):
+        async with AsyncSessionLocal() as database:
+            await database.execute(update(Ingest).where(Ingest.request_code == request_code).values(
+                status=status, error=error, updated_at=func.now()
+            ))
+            await database.commit()
+
+    async def save(self, manifest: dict, directory: str):
+        request_code = manifest['request_code']
+        created_at = datetime.fromisoformat(manifest['created_at'])
+
+        async with AsyncSessionLocal() as database:
+            # The row is missing if the process stopped between writing the manifest and answering
+            ingest = await database.get(Ingest, request_code)
+            if ingest is None:
+                ingest = Ingest(request_code=request_code, user_id=manifest['user_id'], stored=0, skipped=0)
+                database.add(ingest)
+            elif ingest.status == 'done':
+                # Saved before the spool could be removed
+                return
+            ingest.status = 'running'
+            ingest.error = None
+            await database.commit()
+
+            await storage.ensure_bucket(daily_bucket_name(created_at))
+
+            images = []
+            try:
+                for image in manifest['images']:
+                    file = open(os.path.join(directory, image['file_name'] + '.jpg'), 'rb')
+                    images.append(SpooledImage(image['file_name'], file, image['key'], os.fstat(file.fileno()).st_size))
+
+                # Images and the done status are committed together
+                new_keys = await store_images(database, request_code, created_at, images, status='done')
+                await database.commit()
+            finally:
+                for image in images:
+                    image.file.close()
+
+        for key in new_keys:
+            derivative_queue.enqueue(daily_bucket_name(created_at), key)
+
+
+ingest_queue = IngestQueue(INGEST_SPOOL_PATH, INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_RETRIES)
@@ -1,10 +1,50 @@
 from fastapi import FastAPI
-from app.handlers import router
+from app.auth import token_cache
+from app.handlers import images_cache, router
+from app.ingest import ingest_queue
+from app.metrics import MetricsMiddleware, instrument_engine, metrics, stats_collector
+from app.models import async_engine, pool_checkout_stats
+from app.retention import inbox_retention
+from app.storage import storage
+from app.thumbnails import derivative_queue
+from app.uploads import pending_upload_collector
+
+# Keys of TTLCache.stats() which only grow
+CACHE_COUNTERS = ('hits', 'misses', 'evictions', 'expirations')
 
 
 def get_application() -> FastAPI():
     application = FastAPI()
     application.include_router(router)
+    application.add_route('/metrics', metrics, include_in_schema=False)
+
+    # Latency, sizes, database and storage time of every request
+    application.add_middleware(MetricsMiddleware)
+    instrument_engine(async_engine.sync_engine)
+    stats_collector.add('db_pool', 'Connections taken from the database pool', pool_checkout_stats.as_dict,
+                        counters=('checkouts',))
+    stats_collector.add('auth_token_cache', 'Users cached by auth token', token_cache.stats,
+                        counters=CACHE_COUNTERS)
+    stats_collector.add('images_cache', 'Image lists cached by request code', images_cache.stats,
+                        counters=CACHE_COUNTERS)
+    stats_collector.add('presigned_url_cache', 'Presigned URLs cached by object', storage.presigned_urls.stats,
+                        counters=CACHE_COUNTERS)
+    stats_collector.add('derivative_queue', 'Images waiting for smaller copies', derivative_queue.stats,
+                        counters=('processed', 'failed', 'dropped'))
+
+    application.add_event_handler('startup', storage.start)
+    application.add_event_handler('startup', pending_upload_collector.start)
+    application.add_event_handler('startup', derivative_queue.start)
+    application.add_event_handler('startup', inbox_retention.start)
+    application.add_event_handler('startup', ingest_queue.start)
+    application.add_event_handler('shutdown', storage.stop)
+    application.add_event_handler('shutdown', pending_upload_collector.stop)
+    application.add_event_handler('shutdown', derivative_queue.stop)
+    application.add_event_handler('shutdown', inbox_retention.stop)
+    application.add_event_handler('shutdown', ingest_queue.stop)
+
+    # Pooled connections belong to the event loop they were opened in
+    application.add_event_handler('shutdown', async_engine.dispose)
     return application
 
 
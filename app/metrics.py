@@ -0,0 +1,208 @@
+import logging
+import os
+import time
+from collections import Counter as StatementCounter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from starlette.requests import Request
+from starlette.responses import Response
+
+from app.config import SERVER_TIMING
+
+logger = logging.getLogger(__name__)
+
+SIZE_BUCKETS = (100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8)
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Time until the response is sent',
+                             ['method', 'route', 'status'])
+REQUEST_SIZE = Histogram('http_request_size_bytes', 'Size of request bodies', ['method', 'route'],
+                         buckets=SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Size of response bodies', ['method', 'route'],
+                          buckets=SIZE_BUCKETS)
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'Database queries made by one request', ['route'],
+                            buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+DB_QUERY_DURATION = Histogram('db_query_duration_seconds', 'Time of one database query')
+STORAGE_DURATION = Histogram('storage_operation_duration_seconds',
+                             'Time of one storage call, with waiting for a thread', ['operation'])
+DERIVATIVE_LATENCY = Histogram('derivative_latency_seconds',
+                               'Time from queueing an image until its smaller copies are stored',
+                               buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+STORAGE_ERRORS = Counter('storage_operation_errors_total', 'Storage calls which raised', ['operation'])
+REPEATED_QUERIES = Counter('http_request_repeated_db_queries_total',
+                           'Queries which repeated a statement already run by the same request', ['route'])
+
+
+class RequestTimings:
+    # Time spent by one request outside of Python, filled by database events and storage calls
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.storage_time = 0.0
+        self.storage_calls = 0
+        self.statements = []
+        self.repeats_allowed = False
+
+    def repeated_statements(self) -> dict:
+        # Statement -> times it ran, a query per row of a list (N+1) shows up here
+        return {statement: count for statement, count in StatementCounter(self.statements).items() if count > 1}
+
+    def server_timing(self, total: float) -> str:
+        return f'db;dur={self.db_time * 1000:.1f};desc="{self.db_queries} queries", ' \
+               f'storage;dur={self.storage_time * 1000:.1f};desc="{self.storage_calls} calls", ' \
+               f'total;dur={total * 1000:.1f}'
+
+
+class StatsCollector:
+    # Exports stats() dicts of pools, caches and queues, they are read on every scrape
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, prefix: str, description: str, stats, counters: tuple = ()):
+        # Keys in counters only grow, the others are exported as gauges
+        self.sources[prefix] = (description, stats, counters)
+
+    def collect(self):
+        for prefix, (description, stats, counters) in self.sources.items():
+            for key, value in stats().items():
+                family = CounterMetricFamily if key in counters else GaugeMetricFamily
+                yield family(f'{prefix}_{key}', f'{description}: {key}', value=value)
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+request_timings: ContextVar = ContextVar('request_timings', default=None)
+
+
+def allow_repeated_statements():
+    # For requests which save data in batches, each batch runs the same statements
+    timings = request_timings.get()
+    if timings is not None:
+        timings.repeats_allowed = True
+
+
+def record_storage(operation: str, duration: float, failed: bool = False):
+    STORAGE_DURATION.labels(operation).observe(duration)
+    if failed:
+        STORAGE_ERRORS.labels(operation).inc()
+
+    timings = request_timings.get()
+    if timings is not None:
+        timings.storage_time += duration
+        timings.storage_calls += 1
+
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - connection.info['query_started'].pop()
+    DB_QUERY_DURATION.observe(duration)
+
+    # Events of the async engine run in a greenlet of the request's task, which shares its context
+    timings = request_timings.get()
+    if timings is not None:
+        timings.db_time += duration
+        timings.db_queries += 1
+        timings.statements.append(statement)
+
+
+# Called with route and timings after every request, used by tests to check query budgets of endpoints
+request_observers = []
+
+
+@contextmanager
+def recorded_requests():
+    recorded = []
+
+    def observer(route: str, timings: RequestTimings):
+        recorded.append((route, timings))
+
+    request_observers.append(observer)
+    try:
+        yield recorded
+    finally:
+        request_observers.remove(observer)
+
+
+def instrument_engine(engine):
+    # Takes the sync engine, for the async one pass async_engine.sync_engine
+    if not event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, so streamed responses are not buffered
+
+    def __init__(self, app, server_timing: bool = SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+        response_size = 0
+
+        async def send_with_metrics(message):
+            nonlocal status, response_size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                # Storage reads of streamed bodies happen after the headers, they are only in the histograms
+                if self.server_timing:
+                    header = timings.server_timing(time.perf_counter() - started).encode('latin-1')
+                    message['headers'] = [*message.get('headers', []), (b'server-timing', header)]
+            elif message['type'] == 'http.response.body':
+                response_size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            request_timings.reset(token)
+
+            # Handlers are labelled by name, paths contain tokens and codes
+            endpoint = scope.get('endpoint')
+            route = getattr(endpoint, '__name__', 'not_found')
+            method = scope['method']
+            headers = dict(scope['headers'])
+
+            REQUEST_DURATION.labels(method, route, status).observe(time.perf_counter() - started)
+            REQUEST_SIZE.labels(method, route).observe(int(headers.get(b'content-length', 0)))
+            RESPONSE_SIZE.labels(method, route).observe(response_size)
+            REQUEST_QUERIES.labels(route).observe(timings.db_queries)
+
+            # Same statement run again by one request, most likely in a loop
+            repeated = timings.repeated_statements()
+            if repeated and not timings.repeats_allowed:
+                REPEATED_QUERIES.labels(route).inc(sum(repeated.values()) - len(repeated))
+                for statement, count in repeated.items():
+                    logger.warning('%s ran the same statement %s times: %s', route, count, ' '.join(statement.split()))
+
+            for observer in request_observers:
+                observer(route, timings)
+
+
+def metrics(request: Request) -> Response:
+    # With several worker processes every one writes to PROMETHEUS_MULTIPROC_DIR and they are summed here
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        # Stats are kept in memory, these are of the process which answers the scrape
+        registry.register(stats_collector)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -1,21 +1,104 @@
-from datetime import datetime
-
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
-from sqlalchemy.orm import Session
+import logging
+import threading
+import time
+
+import urllib3
+from sqlalchemy import create_engine, Column, DateTime, Index, Integer, String, ForeignKey, func
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 from minio import Minio
 
-from app.config import DATABASE_URL, MINIO_SECRET_KEY, MINIO_ACCESS_KEY, MINIO_HOST
+from app.config import DATABASE_URL, ASYNC_DATABASE_URL, STORAGE_THREADS, MINIO_SECRET_KEY, MINIO_ACCESS_KEY, \
+    MINIO_HOST, MINIO_REGION, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT, DATABASE_POOL_RECYCLE, \
+    DATABASE_POOL_PRE_PING, DATABASE_POOL_SLOW_CHECKOUT
+
+logger = logging.getLogger(__name__)
+
+
+class PoolCheckoutStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'avg_wait': self.total_wait / self.checkouts if self.checkouts else 0.0,
+            }
+
+
+pool_checkout_stats = PoolCheckoutStats()
+
+
+class TimedPoolMixin:
+
+    def _do_get(self):
+        # Measure how long a request waits for a free connection
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - started
+            pool_checkout_stats.record(wait)
+            if wait >= DATABASE_POOL_SLOW_CHECKOUT:
+                logger.warning('Waited %.3fs for a database connection (%s)', wait, self.status())
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
 
 
-def connect_db():
-    engine = create_engine(DATABASE_URL)
-    session = Session(bind=engine)
-    return session
+pool_options = dict(
+    pool_size=DATABASE_POOL_SIZE,
+    max_overflow=DATABASE_MAX_OVERFLOW,
+    pool_timeout=DATABASE_POOL_TIMEOUT,
+    pool_recycle=DATABASE_POOL_RECYCLE,
+    pool_pre_ping=DATABASE_POOL_PRE_PING,
+)
 
+# One engine (and one connection pool) per worker process.
+# Handlers use the async engine, the sync one is left for scripts and tests.
+engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **pool_options)
+SessionLocal = sessionmaker(bind=engine)
 
-minio_client = Minio(MINIO_HOST, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, secure=False)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=TimedAsyncQueuePool, **pool_options)
+AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def connect_db():
+    async with AsyncSessionLocal() as session:
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+
+
+minio_client = Minio(MINIO_HOST, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, secure=False, region=MINIO_REGION,
+                     http_client=urllib3.PoolManager(
+                         maxsize=STORAGE_THREADS,
+                         timeout=urllib3.Timeout(connect=300, read=300),
+                         retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+                     ))
 Base = declarative_base()
 
 
@@ -24,26 +107,71 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     group = Column(String, default='user')
-    email = Column(String)
+    email = Column(String, unique=True, index=True)
     password = Column(String)
     first_name = Column(String)
     last_name = Column(String)
     nickname = Column(String)
-    created_at = Column(String, default=datetime.utcnow())
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
 class AuthToken(Base):
     __tablename__ = 'auth_token'
 
     id = Column(Integer, primary_key=True)
-    token = Column(String)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    created_at = Column(String, default=datetime.utcnow())
+    token = Column(String, unique=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), unique=True, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
 class Inbox(Base):
     __tablename__ = 'inbox'
 
-    request_code = Column(String)
+    # Partitioned by day of the request code (inbox_YYYYMMDD), the same as buckets, see app/retention.py.
+    # Primary key of a partitioned table has to contain the partition key, it also serves lookups by request_code.
+    request_code = Column(String, primary_key=True)
+    file_name = Column(String, primary_key=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Content hash the image is stored under, see Blob. Empty for images stored under file_name.
+    blob_key = Column(String)
+
+    # Rows are only appended, listing by time pages through this index in (created_at, request_code) order
+    __table_args__ = (
+        Index('ix_inbox_created_at_request_code', 'created_at', 'request_code'),
+        {'postgresql_partition_by': 'RANGE (request_code)'},
+    )
+
+
+class Blob(Base):
+    __tablename__ = 'blobs'
+
+    # Object of a bucket named by the sha256 of its content, shared by all images of the day with the same bytes.
+    # ref_count is the number of inbox rows pointing to it, the row and the object are removed with the last one.
+    bucket_name = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    ref_count = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class Ingest(Base):
+    __tablename__ = 'ingests'
+
+    # Progress of images uploaded in an archive, updated with every saved batch
+    request_code = Column(String, primary_key=True)
+    user_id = Column(Integer, index=True)
+    status = Column(String, nullable=False, default='running')
+    stored = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class PendingUpload(Base):
+    __tablename__ = 'pending_upload'
+
+    request_code = Column(String, index=True)
     file_name = Column(String, primary_key=True)
-    created_at = Column(String, default=str(datetime.utcnow())[:-7])
+    # Only the user who started the upload can commit it
+    user_id = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
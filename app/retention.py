@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, text
+
+from app.config import INBOX_RETENTION_DAYS, RETENTION_INTERVAL
+from app.models import Blob, Inbox, Ingest, async_engine
+from app.storage import daily_bucket_name, storage
+
+logger = logging.getLogger(__name__)
+
+# Only one worker changes partitions at a time, others skip the round
+PARTITIONS_LOCK = 7241018
+
+DAY = re.compile(r'^\d{8}$')
+
+
+def partition_name(day: str) -> str:
+    return f'inbox_{day}'
+
+
+def partition_ddl(day: str) -> str:
+    # Request codes start with the day, so the day's partition holds codes from YYYYMMDD to the next day
+    next_day = daily_bucket_name(datetime.strptime(day, '%Y%m%d') + timedelta(days=1))
+    return f"create table if not exists {partition_name(day)} partition of inbox for values from ('{day}') to " \
+           f"('{next_day}')"
+
+
+def default_partition_ddl() -> str:
+    # Codes which don't start with a day
+    return 'create table if not exists inbox_default partition of inbox default'
+
+
+async def list_partitions(connection) -> list:
+    names = (await connection.execute(text(
+        "select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid "
+        "join pg_class p on p.oid = i.inhparent where p.relname = 'inbox'"
+    ))).scalars().all()
+    return sorted(name[len('inbox_'):] for name in names if DAY.match(name[len('inbox_'):]))
+
+
+async def maintain_partitions(retention_days: int, now: datetime = None):
+    # Make partitions for today and tomorrow and drop those older than retention_days.
+    # Returns days which were dropped, None if another worker is doing it.
+    now = now or datetime.utcnow()
+    days = [daily_bucket_name(now), daily_bucket_name(now + timedelta(days=1))]
+    expired = []
+
+    async with async_engine.begin() as connection:
+        if not (await connection.execute(text('select pg_try_advisory_xact_lock(:key)'),
+                                         {'key': PARTITIONS_LOCK})).scalar():
+            return None
+
+        for day in days:
+            try:
+                async with connection.begin_nested():
+                    await connection.execute(text(partition_ddl(day)))
+            except Exception:
+                # Rows of the day are already in the default partition
+                logger.exception('Could not create inbox partition for %s', day)
+
+        if retention_days > 0:
+            cutoff = daily_bucket_name(now - timedelta(days=retention_days))
+            expired = [day for day in await list_partitions(connection) if day < cutoff]
+
+            # Dropping a partition is instant, no matter how many rows it has
+            for day in expired:
+                await connection.execute(text(f'alter table inbox detach partition {partition_name(day)}'))
+                await connection.execute(text(f'drop table {partition_name(day)}'))
+
+            # Days without their own partition (e.g. rows from before partitioning) are in the default one,
+            # codes which don't start with a day are kept
+            await connection.execute(delete(Inbox).where(
+                Inbox.request_code < cutoff, Inbox.request_code.regexp_match('^[0-9]{8}')
+            ))
+
+            # Stored images of those days are removed with their buckets
+            await connection.execute(delete(Blob).where(Blob.bucket_name < cutoff))
+            await connection.execute(delete(Ingest).where(Ingest.request_code < cutoff))
+
+    return expired
+
+
+async def remove_expired_buckets(retention_days: int, now: datetime = None) -> list:
+    # Called after partitions are dropped, so images are never listed without their objects
+    cutoff = daily_bucket_name((now or datetime.utcnow()) - timedelta(days=retention_days))
+    removed = []
+
+    for bucket_name in sorted(await storage.list_buckets()):
+        if DAY.match(bucket_name) and bucket_name < cutoff:
+            try:
+                await storage.remove_bucket(bucket_name)
+                removed.append(bucket_name)
+            except Exception:
+                logger.exception('Could not remove bucket %s, it is tried again next time', bucket_name)
+
+    return removed
+
+
+class InboxRetention:
+
+    def __init__(self, retention_days: int, interval: int):
+        self.retention_days = retention_days
+        self.interval = interval
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                dropped = await maintain_partitions(self.retention_days)
+                if dropped:
+                    logger.info('Dropped inbox partitions of %s', ', '.join(dropped))
+
+                if dropped is not None and self.retention_days > 0:
+                    removed = await remove_expired_buckets(self.retention_days)
+                    if removed:
+                        logger.info('Removed buckets %s', ', '.join(removed))
+            except Exception:
+                logger.exception('Could not maintain inbox partitions')
+
+            await asyncio.sleep(self.interval)
+
+
+inbox_retention = InboxRetention(INBOX_RETENTION_DAYS, RETENTION_INTERVAL)
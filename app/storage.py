@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from functools import partial
+
+import anyio
+
+from app.backends import StorageError, make_backend
+from app.cache import TTLCache
+from app.config import STORAGE_THREADS, BUCKET_PROVISION_LEAD, DOWNLOAD_CHUNK_SIZE, PRESIGN_EXPIRY, \
+    PRESIGN_REFRESH_MARGIN, PRESIGN_CACHE_SIZE, PRESIGN_UPLOAD_EXPIRY, STORAGE_BACKEND
+from app.metrics import record_storage
+
+logger = logging.getLogger(__name__)
+
+REMOVE_OBJECTS_BATCH = 1000
+
+
+def daily_bucket_name(moment: datetime) -> str:
+    return moment.strftime('%Y%m%d')
+
+
+class Storage:
+
+    def __init__(self, client, max_threads: int):
+        # One of app.backends, its methods are blocking
+        self.client = client
+        self.max_threads = max_threads
+        self._limiter = None
+        self._provisioner = None
+
+        # Buckets which are known to exist, so uploads don't have to ask MinIO every time
+        self.known_buckets = set()
+
+        # (bucket, object) -> presigned GET url, kept until shortly before the url expires
+        self.presigned_urls = TTLCache(PRESIGN_CACHE_SIZE, PRESIGN_EXPIRY - PRESIGN_REFRESH_MARGIN)
+
+    @property
+    def limiter(self) -> anyio.CapacityLimiter:
+        # Created lazily because the limiter has to be made inside a running event loop
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(self.max_threads)
+        return self._limiter
+
+    async def run(self, func, *args, **kwargs):
+        # Backends are blocking, so every call is moved to a worker thread
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await anyio.to_thread.run_sync(partial(func, *args, **kwargs), limiter=self.limiter)
+            failed = False
+            return result
+        finally:
+            record_storage(func.__name__, time.perf_counter() - started, failed)
+
+    async def start(self):
+        try:
+            # Remember existing buckets and make today's one before the first upload
+            self.known_buckets.update(await self.list_buckets())
+            await self.ensure_bucket(daily_bucket_name(datetime.utcnow()))
+        except Exception:
+            logger.exception('Could not load buckets on startup, they will be checked on upload')
+
+        self._provisioner = asyncio.create_task(self.provision_buckets())
+
+    async def stop(self):
+        if self._provisioner:
+            self._provisioner.cancel()
+            self._provisioner = None
+        self._limiter = None
+
+    async def provision_buckets(self):
+        # Create tomorrow's bucket a bit before midnight UTC, so the first upload of the day doesn't wait for it
+        while True:
+            now = datetime.utcnow()
+            tomorrow = datetime(now.year, now.month, now.day) + timedelta(days=1)
+            await asyncio.sleep(max((tomorrow - now).total_seconds() - BUCKET_PROVISION_LEAD, 0))
+
+            try:
+                await self.ensure_bucket(daily_bucket_name(tomorrow))
+            except Exception:
+                logger.exception('Could not create bucket for %s', tomorrow.date())
+
+            # Wait for the day to change before planning the next one
+            await asyncio.sleep(max((tomorrow - datetime.utcnow()).total_seconds(), 0) + 1)
+
+    async def ensure_bucket(self, bucket_name: str):
+        if bucket_name in self.known_buckets:
+            return
+
+        if not await self.bucket_exists(bucket_name):
+            try:
+                await self.make_bucket(bucket_name)
+            except StorageError as error:
+                # Another worker was faster
+                if error.code not in ['BucketAlreadyOwnedByYou', 'BucketAlreadyExists']:
+                    raise
+
+        self.known_buckets.add(bucket_name)
+
+    async def bucket_exists(self, bucket_name: str) -> bool:
+        return await self.run(self.client.bucket_exists, bucket_name)
+
+    async def make_bucket(self, bucket_name: str):
+        return await self.run(self.client.make_bucket, bucket_name)
+
+    async def list_buckets(self) -> list:
+        return await self.run(self.client.list_buckets)
+
+    async def remove_bucket(self, bucket_name: str):
+        # Buckets must be empty before they are removed, all objects go in batches of multi-object deletes
+        errors = await self.remove_objects(bucket_name, await self.run(self.client.list_objects, bucket_name))
+        if errors:
+            raise errors[0]
+
+        self.known_buckets.discard(bucket_name)
+        await self.run(self.client.remove_bucket, bucket_name)
+
+    async def put_object(self, bucket_name: str, object_name: str, data, length: int, **kwargs):
+        position = data.tell()
+        try:
+            return await self.run(self.client.put_object, bucket_name, object_name, data, length, **kwargs)
+        except StorageError as error:
+            if error.code != 'NoSuchBucket':
+                raise
+
+        # Bucket was removed after it was cached or is not provisioned yet, create it and retry once
+        self.known_buckets.discard(bucket_name)
+        await self.ensure_bucket(bucket_name)
+        data.seek(position)
+        return await self.run(self.client.put_object, bucket_name, object_name, data, length, **kwargs)
+
+    async def stat_object(self, bucket_name: str, object_name: str):
+        return await self.run(self.client.stat_object, bucket_name, object_name)
+
+    async def stat_objects(self, bucket_name: str, object_names: list, concurrency: int) -> dict:
+        # S3 has no batch stat, so objects are checked in parallel. Missing objects get None.
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def stat(object_name):
+            async with semaphore:
+                try:
+                    return await self.stat_object(bucket_name, object_name)
+                except StorageError as error:
+                    if error.code not in ['NoSuchKey', 'NoSuchObject']:
+                        raise
+                    return None
+
+        return dict(zip(object_names, await asyncio.gather(*[stat(object_name) for object_name in object_names])))
+
+    async def stream_object(self, bucket_name: str, object_name: str, offset: int = 0, length: int = 0,
+                            chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        # Yields the object (or its range) chunk by chunk, nothing more than one chunk is kept in memory
+        response = await self.run(self.client.get_object, bucket_name, object_name, offset, length)
+        try:
+            while True:
+                chunk = await self.run(response.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    def presigned_get_url(self, bucket_name: str, object_name: str) -> str:
+        # Signing is local, so it runs inline
+        url = self.presigned_urls.get((bucket_name, object_name))
+        if url is None:
+            url = self.client.presigned_get_url(bucket_name, object_name, timedelta(seconds=PRESIGN_EXPIRY))
+            self.presigned_urls.set((bucket_name, object_name), url)
+        return url
+
+    def presigned_put_url(self, bucket_name: str, object_name: str) -> str:
+        return self.client.presigned_put_url(bucket_name, object_name, timedelta(seconds=PRESIGN_UPLOAD_EXPIRY))
+
+    async def remove_object(self, bucket_name: str, object_name: str):
+        return await self.run(self.client.remove_object, bucket_name, object_name)
+
+    async def remove_objects(self, bucket_name: str, object_names: list) -> list:
+        # Multi-object delete, S3 accepts up to 1000 keys per request. Returns StorageError for failed keys.
+        errors = []
+        for start in range(0, len(object_names), REMOVE_OBJECTS_BATCH):
+            batch = object_names[start:start + REMOVE_OBJECTS_BATCH]
+            errors.extend(await self.run(self.client.remove_objects, bucket_name, batch))
+        return errors
+
+    async def put_objects(self, bucket_name: str, objects: list, concurrency: int, **kwargs):
+        # Objects are (object_name, data, length) tuples
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def put(object_name, data, length):
+            async with semaphore:
+                await self.put_object(bucket_name, object_name, data, length, **kwargs)
+
+        results = await asyncio.gather(*[put(*item) for item in objects], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+
+        # If something failed remove objects which were uploaded, so no orphans stay in the bucket
+        if errors:
+            landed = [item[0] for item, result in zip(objects, results) if not isinstance(result, BaseException)]
+            await asyncio.gather(*[self.remove_object(bucket_name, object_name) for object_name in landed],
+                                 return_exceptions=True)
+            raise errors[0]
+
+
+storage = Storage(make_backend(STORAGE_BACKEND), STORAGE_THREADS)
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from PIL import Image
+
+from app.config import DERIVATIVE_SIZES, DERIVATIVE_QUALITY, DERIVATIVE_WORKERS, DERIVATIVE_QUEUE_SIZE
+from app.metrics import DERIVATIVE_LATENCY
+from app.storage import storage
+
+logger = logging.getLogger(__name__)
+
+
+def derivative_name(file_name: str, size: int) -> str:
+    return f'{file_name}_{size}'
+
+
+def render_derivatives(data: bytes, sizes: list, quality: int) -> dict:
+    # Runs in a worker process, returns size -> jpeg bytes
+    derivatives = {}
+    with Image.open(BytesIO(data)) as image:
+        # Let the jpeg decoder skip detail which is not needed for the biggest size
+        image.draft('RGB', (max(sizes), max(sizes)))
+        image = image.convert('RGB')
+
+        for size in sizes:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size))
+            output = BytesIO()
+            thumbnail.save(output, format='JPEG', quality=quality, optimize=True)
+            derivatives[size] = output.getvalue()
+
+    return derivatives
+
+
+class DerivativeQueue:
+
+    def __init__(self, sizes: list, quality: int, workers: int, maxsize: int):
+        self.sizes = sizes
+        self.quality = quality
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue = None
+        self._executor = None
+        self._tasks = []
+        # Images waiting or being made, a missing copy is asked for by every download until it is stored
+        self._pending = set()
+
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    async def start(self):
+        if not self.sizes:
+            return
+        self._queue = asyncio.Queue(self.maxsize)
+        self._executor = self.make_executor()
+        self._tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    def make_executor(self) -> ProcessPoolExecutor:
+        # Forking a process with running threads and event loop is unsafe, workers start clean
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._queue = None
+        self._pending.clear()
+
+    def enqueue(self, bucket_name: str, file_name: str):
+        if self._queue is None or (bucket_name, file_name) in self._pending:
+            return
+
+        # Requests never wait for the queue, if it is full the derivatives of this image are skipped
+        try:
+            self._queue.put_nowait((bucket_name, file_name, time.perf_counter()))
+            self._pending.add((bucket_name, file_name))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning('Derivative queue is full, skipped %s', file_name)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # stop() drops the queue while this task is being cancelled
+        queue = self._queue
+        while True:
+            bucket_name, file_name, queued_at = await queue.get()
+            try:
+                data = b''.join([chunk async for chunk in storage.stream_object(bucket_name, file_name + '.jpg')])
+                derivatives = await loop.run_in_executor(self._executor, render_derivatives, data, self.sizes,
+                                                         self.quality)
+
+                for size, derivative in derivatives.items():
+                    await storage.put_object(bucket_name, derivative_name(file_name, size) + '.jpg',
+                                             BytesIO(derivative), len(derivative), content_type='image/jpeg')
+
+                self.processed += 1
+                latency = time.perf_counter() - queued_at
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                DERIVATIVE_LATENCY.observe(latency)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory), the pool can't be used anymore
+                self.failed += 1
+                logger.exception('Derivative workers crashed on %s, starting new ones', file_name)
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self.make_executor()
+            except Exception:
+                self.failed += 1
+                logger.exception('Could not make derivatives of %s', file_name)
+            finally:
+                self._pending.discard((bucket_name, file_name))
+                queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize() if self._queue else 0,
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'avg_latency': self.total_latency / self.processed if self.processed else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+
+derivative_queue = DerivativeQueue(DERIVATIVE_SIZES, DERIVATIVE_QUALITY, DERIVATIVE_WORKERS, DERIVATIVE_QUEUE_SIZE)
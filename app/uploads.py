@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+
+from sqlalchemy import delete, select
+
+from app.config import PENDING_UPLOAD_TTL, PENDING_UPLOAD_GC_INTERVAL
+from app.models import AsyncSessionLocal, PendingUpload
+from app.storage import storage
+
+logger = logging.getLogger(__name__)
+
+GC_BATCH = 1000
+
+
+async def collect_pending_uploads() -> int:
+    # Remove direct uploads which were started but never committed, together with anything put to MinIO
+    expired_before = datetime.now(timezone.utc) - timedelta(seconds=PENDING_UPLOAD_TTL)
+
+    async with AsyncSessionLocal() as database:
+        # Uploads being committed are locked, they are skipped instead of removed under the commit
+        expired = (await database.execute(
+            select(PendingUpload).where(PendingUpload.created_at < expired_before).order_by(
+                PendingUpload.request_code
+            ).limit(GC_BATCH).with_for_update(skip_locked=True)
+        )).scalars().all()
+
+        removed = []
+        for bucket_name, uploads in groupby(expired, key=lambda upload: upload.request_code[:8]):
+            uploads = list(uploads)
+            errors = await storage.remove_objects(bucket_name, [upload.file_name + '.jpg' for upload in uploads])
+            failed = {error.name for error in errors}
+            removed += [upload.file_name for upload in uploads if upload.file_name + '.jpg' not in failed]
+
+        if removed:
+            await database.execute(delete(PendingUpload).where(PendingUpload.file_name.in_(removed)))
+            await database.commit()
+
+    return len(removed)
+
+
+class PendingUploadCollector:
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                removed = await collect_pending_uploads()
+                if removed:
+                    logger.info('Removed %s uncommitted uploads', removed)
+            except Exception:
+                logger.exception('Could not remove uncommitted uploads')
+
+            await asyncio.sleep(self.interval)
+
+
+pending_upload_collector = PendingUploadCollector(PENDING_UPLOAD_GC_INTERVAL)
@@ -1,6 +1,142 @@
+import asyncio
+import base64
 import hashlib
-from app.config import SECRET_KEY
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from app.config import SECRET_KEY, PASSWORD_HASH_ALGORITHM, PASSWORD_HASH_WORKERS, PBKDF2_ITERATIONS, SCRYPT_N, \
+    SCRYPT_R, SCRYPT_P
 
 
 def get_password_hash(password) -> str:
     return hashlib.sha256(f'{SECRET_KEY}{password}'.encode('utf8')).hexdigest()
+
+
+def peppered(password) -> bytes:
+    return f'{SECRET_KEY}{password}'.encode('utf8')
+
+
+def b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+class Sha256Hasher:
+    # Old hashes, stored as plain hex digest without salt
+    name = 'sha256'
+
+    def hash(self, password) -> str:
+        return get_password_hash(password)
+
+    def verify(self, password, encoded: str) -> bool:
+        return hmac.compare_digest(get_password_hash(password), encoded)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return False
+
+
+class Pbkdf2Hasher:
+    # pbkdf2_sha256$iterations$salt$hash
+    name = 'pbkdf2_sha256'
+
+    def __init__(self, iterations: int):
+        self.iterations = iterations
+
+    def derive(self, password, salt: bytes, iterations: int) -> bytes:
+        return hashlib.pbkdf2_hmac('sha256', peppered(password), salt, iterations)
+
+    def hash(self, password) -> str:
+        salt = os.urandom(16)
+        digest = self.derive(password, salt, self.iterations)
+        return f'{self.name}${self.iterations}${b64encode(salt)}${b64encode(digest)}'
+
+    def verify(self, password, encoded: str) -> bool:
+        _, iterations, salt, digest = encoded.split('$')
+        return hmac.compare_digest(
+            self.derive(password, base64.b64decode(salt), int(iterations)), base64.b64decode(digest)
+        )
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return int(encoded.split('$')[1]) != self.iterations
+
+
+class ScryptHasher:
+    # scrypt$n$r$p$salt$hash
+    name = 'scrypt'
+
+    def __init__(self, n: int, r: int, p: int):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def derive(self, password, salt: bytes, n: int, r: int, p: int) -> bytes:
+        # Memory needed is 128 * n * r bytes, hashlib refuses more than maxmem
+        return hashlib.scrypt(peppered(password), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+
+    def hash(self, password) -> str:
+        salt = os.urandom(16)
+        digest = self.derive(password, salt, self.n, self.r, self.p)
+        return f'{self.name}${self.n}${self.r}${self.p}${b64encode(salt)}${b64encode(digest)}'
+
+    def verify(self, password, encoded: str) -> bool:
+        _, n, r, p, salt, digest = encoded.split('$')
+        return hmac.compare_digest(
+            self.derive(password, base64.b64decode(salt), int(n), int(r), int(p)), base64.b64decode(digest)
+        )
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return tuple(map(int, encoded.split('$')[1:4])) != (self.n, self.r, self.p)
+
+
+HASHERS = {
+    hasher.name: hasher for hasher in [
+        Sha256Hasher(),
+        Pbkdf2Hasher(PBKDF2_ITERATIONS),
+        ScryptHasher(SCRYPT_N, SCRYPT_R, SCRYPT_P),
+    ]
+}
+
+# hashlib releases the GIL while deriving keys, so threads are enough to keep the event loop free
+hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+
+
+def get_hasher(encoded: str):
+    # Old sha256 hashes have no algorithm prefix
+    if '$' not in encoded:
+        return HASHERS[Sha256Hasher.name]
+    return HASHERS[encoded.split('$', 1)[0]]
+
+
+def verify(password, encoded: str) -> tuple:
+    hasher = get_hasher(encoded)
+    if not hasher.verify(password, encoded):
+        return False, False
+
+    # Hashes made by another algorithm or with other cost are replaced
+    return True, hasher is not HASHERS[PASSWORD_HASH_ALGORITHM] or hasher.needs_rehash(encoded)
+
+
+@lru_cache(maxsize=1)
+def dummy_hash() -> str:
+    # Made by the current hasher from a random password, no password matches it
+    return HASHERS[PASSWORD_HASH_ALGORITHM].hash(os.urandom(16).hex())
+
+
+def verify_unknown(password) -> tuple:
+    # Costs the same as checking a registered user, so response time doesn't tell whether the email exists
+    verify(password, dummy_hash())
+    return False, False
+
+
+async def hash_password(password) -> str:
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, HASHERS[PASSWORD_HASH_ALGORITHM].hash,
+                                                            password)
+
+
+async def verify_password(password, encoded: Optional[str]) -> tuple:
+    # Returns (is valid, should be hashed again with current settings), encoded is None for unknown users
+    if encoded is None:
+        return await asyncio.get_running_loop().run_in_executor(hash_executor, verify_unknown, password)
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, verify, password, encoded)
@@ -0,0 +1,121 @@
+import argparse
+import itertools
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Load generator for a running server.
+# To compare with the previous code run the old commit on another port and pass it as --baseline-url:
+#   python -m benchmarks.load --url http://localhost:8000 --baseline-url http://localhost:8001 \
+#       --scenario get_images --token <token> --code <code>
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def make_request(scenario: str, args):
+    if scenario == 'root':
+        return 'GET', '/', {}
+    if scenario == 'login':
+        return 'POST', '/login', {'json': {'user_form': {'email': args.email, 'password': args.password}}}
+    if scenario == 'get_images':
+        return 'GET', f'/frames/{args.token}/{args.code}', {}
+    if scenario == 'upload':
+        with open(args.image, 'rb') as image:
+            data = image.read()
+        files = [('files', (f'{number}.jpg', data, 'image/jpeg')) for number in range(args.frames)]
+        return 'POST', f'/frames/{args.token}', {'files': files}
+    raise ValueError(f'Unknown scenario {scenario}')
+
+
+def measure(url: str, make, count: int, concurrency: int, warm_up: bool = True, on_response=None) -> dict:
+    # make(number) returns (method, path, requests kwargs) of the request with this number,
+    # on_response(response) sees every response, e.g. to collect created ids
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    numbers = itertools.count()
+
+    def worker(_):
+        nonlocal errors
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+
+        method, path, kwargs = make(next(numbers))
+        started = time.perf_counter()
+        response = local.session.request(method, url + path, **kwargs)
+        elapsed = time.perf_counter() - started
+
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                errors += 1
+        if on_response:
+            on_response(response)
+
+    # Warm up connections and caches before measuring
+    if warm_up:
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+        latencies.clear()
+        errors = 0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(count)))
+    duration = time.perf_counter() - started
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / duration,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def run(url: str, args) -> dict:
+    request = make_request(args.scenario, args)
+    return measure(url, lambda number: request, args.requests, args.concurrency)
+
+
+def print_result(name: str, result: dict):
+    print(f'{name}: {result["requests"]} requests, {result["errors"]} errors, {result["rps"]:.1f} req/s, '
+          f'p50 {result["p50_ms"]:.1f} ms, p95 {result["p95_ms"]:.1f} ms, p99 {result["p99_ms"]:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure requests/sec and latency percentiles of the API')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--baseline-url', help='Server running the code to compare against')
+    parser.add_argument('--scenario', choices=['root', 'login', 'get_images', 'upload'], default='get_images')
+    parser.add_argument('--email', help='Email for login, all workers log in as this user concurrently')
+    parser.add_argument('--password', help='Password for login')
+    parser.add_argument('--token', help='Auth token (admin/moderator for uploads)')
+    parser.add_argument('--code', help='Request code for get_images')
+    parser.add_argument('--image', default='tests/images_for_test/testimage.jpg')
+    parser.add_argument('--frames', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    result = run(args.url, args)
+    print_result(args.url, result)
+
+    if args.baseline_url:
+        baseline = run(args.baseline_url, args)
+        print_result(args.baseline_url, baseline)
+        print(f'throughput x{result["rps"] / baseline["rps"]:.2f}, '
+              f'p99 x{result["p99_ms"] / baseline["p99_ms"]:.2f} compared to baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import time
+
+from app.config import PASSWORD_HASH_WORKERS
+from app.utils import HASHERS, Pbkdf2Hasher, ScryptHasher, hash_executor
+
+# Logins per second one worker process can verify for different hash costs:
+#   python -m benchmarks.password_hashing --logins 200 --concurrency 64
+
+
+async def measure(hasher, logins: int, concurrency: int) -> tuple:
+    encoded = hasher.hash('password')
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    lags = []
+
+    async def login():
+        async with semaphore:
+            await loop.run_in_executor(hash_executor, hasher.verify, 'password', encoded)
+
+    async def watch_loop():
+        # How late the event loop wakes up while hashing runs, it should stay near zero
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    watcher = asyncio.create_task(watch_loop())
+    started = time.perf_counter()
+    await asyncio.gather(*[login() for _ in range(logins)])
+    duration = time.perf_counter() - started
+    watcher.cancel()
+
+    return logins / duration, max(lags, default=0)
+
+
+async def run(args):
+    hashers = [HASHERS['sha256']]
+    hashers += [Pbkdf2Hasher(iterations) for iterations in args.pbkdf2_iterations]
+    hashers += [ScryptHasher(n, 8, 1) for n in args.scrypt_n]
+
+    print(f'{PASSWORD_HASH_WORKERS} hashing threads, {args.concurrency} concurrent logins')
+    for hasher in hashers:
+        cost = getattr(hasher, 'iterations', None) or getattr(hasher, 'n', None) or '-'
+        logins_per_second, max_lag = await measure(hasher, args.logins, args.concurrency)
+        print(f'{hasher.name} cost {cost}: {logins_per_second:.1f} logins/s, '
+              f'max event loop lag {max_lag * 1000:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure login throughput against password hash cost')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--pbkdf2-iterations', type=int, nargs='*', default=[100000, 260000, 600000])
+    parser.add_argument('--scrypt-n', type=int, nargs='*', default=[2 ** 13, 2 ** 14, 2 ** 15])
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
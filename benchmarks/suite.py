@@ -0,0 +1,189 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+
+import requests
+
+from benchmarks.load import measure, print_result
+
+# Runs every endpoint against a server started here with in-memory (or local file) storage and a local Postgres,
+# then compares with the baseline committed in benchmarks/baseline.json (exits with 1 on regressions):
+#   python -m benchmarks.suite
+#   python -m benchmarks.suite --save benchmarks/baseline.json     (to measure a new baseline, e.g. on other hardware)
+# Use a separate DATABASE_NAME, the suite creates users and images and doesn't clean them up.
+
+IMAGES = sorted(glob.glob('tests/images_for_test/*.jpg'))
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def start_server(args) -> subprocess.Popen:
+    env = {**os.environ, 'STORAGE_BACKEND': args.storage, 'STORAGE_PATH': args.storage_path}
+    # Background resizing would take CPU from the scenarios which run after uploads
+    if not args.derivatives:
+        env['DERIVATIVE_SIZES'] = ''
+    if args.database_name:
+        env['DATABASE_NAME'] = args.database_name
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(args.port), '--workers', str(args.workers),
+         '--log-level', 'warning'],
+        env=env,
+    )
+
+    # Wait until the server answers
+    for _ in range(100):
+        try:
+            requests.get(f'http://127.0.0.1:{args.port}/', timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError('Server did not start')
+
+
+def upload_files(frames: int) -> list:
+    files = []
+    for number in range(frames):
+        with open(IMAGES[number % len(IMAGES)], 'rb') as image:
+            files.append(('files', (f'{number}.jpg', image.read(), 'image/jpeg')))
+    return files
+
+
+def run_scenarios(url: str, args) -> dict:
+    run_id = uuid.uuid4().hex[:8]
+    results = {}
+
+    # Admin who uploads and deletes images in all scenarios
+    email, password = f'admin-bench-{run_id}@bench.com', 'password'
+    requests.post(f'{url}/user', json={'user': {'email': email, 'password': password}}).raise_for_status()
+    token = requests.post(f'{url}/login', json={'user_form': {'email': email, 'password': password}}).json()[
+        'Auth Token']
+
+    results['create_user'] = measure(url, lambda number: (
+        'POST', '/user', {'json': {'user': {'email': f'user-bench-{run_id}-{number}@bench.com', 'password': '1'}}}
+    ), args.requests, args.concurrency)
+
+    login = {'json': {'user_form': {'email': email, 'password': password}}}
+    results['login'] = measure(url, lambda number: ('POST', '/login', login), args.requests, args.concurrency)
+
+    # Login replaced the token, take the latest one
+    token = requests.post(f'{url}/login', **login).json()['Auth Token']
+
+    # Codes of uploaded images are deleted in the last scenario
+    codes = []
+    for frames in [1, 5, 15]:
+        files = upload_files(frames)
+        results[f'upload_{frames}'] = measure(
+            url, lambda number: ('POST', f'/frames/{token}', {'files': files}), args.requests, args.concurrency,
+            on_response=lambda response: codes.extend(response.json()) if response.status_code == 200 else None,
+        )
+
+    if not codes:
+        raise RuntimeError('No upload succeeded, nothing to get and delete')
+
+    results['get_images'] = measure(
+        url, lambda number: ('GET', f'/frames/{token}/{codes[number % len(codes)]}', {}), args.requests,
+        args.concurrency,
+    )
+
+    # Every code can be deleted once, so there is no warm up
+    results['delete_images'] = measure(url, lambda number: ('DELETE', f'/frames/{token}/{codes[number]}', {}),
+                                       min(args.requests, len(codes)), args.concurrency, warm_up=False)
+
+    return results
+
+
+def median_results(runs: list) -> dict:
+    # One slow run (e.g. another process took the cpu) shouldn't decide, every scenario keeps its median run
+    results = {}
+    for name in runs[0]:
+        ordered = sorted((run[name] for run in runs), key=lambda result: result['rps'])
+        results[name] = ordered[len(ordered) // 2]
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    # Scenarios which got slower than the baseline by more than threshold percent
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+
+        if result['rps'] < old['rps'] * (1 - threshold / 100):
+            regressions.append(f'{name}: {old["rps"]:.1f} -> {result["rps"]:.1f} req/s')
+        if result['p95_ms'] > old['p95_ms'] * (1 + threshold / 100):
+            regressions.append(f'{name}: p95 {old["p95_ms"]:.1f} -> {result["p95_ms"]:.1f} ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark all endpoints against local stand-ins')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--storage', choices=['memory', 'local'], default='memory')
+    parser.add_argument('--storage-path', default='/tmp/fastapi-proj-bench')
+    parser.add_argument('--derivatives', action='store_true', help='Make smaller copies of uploaded images')
+    parser.add_argument('--database-name', help='Database of the server, DATABASE_NAME from .env by default')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--runs', type=int, default=3, help='Times every scenario runs, the median run is kept')
+    parser.add_argument('--save', help='Write results to this file, to use as a baseline later')
+    parser.add_argument('--baseline', default=BASELINE, help='Compare with results saved by --save, empty to skip')
+    parser.add_argument('--threshold', type=float, default=10, help='Allowed slowdown against baseline, percent')
+    args = parser.parse_args()
+
+    # Every worker would have its own memory storage
+    if args.storage == 'memory' and args.workers > 1:
+        parser.error('memory storage works with one worker only, use --storage local')
+
+    server = start_server(args)
+    try:
+        results = median_results([run_scenarios(f'http://127.0.0.1:{args.port}', args) for _ in range(args.runs)])
+    finally:
+        server.terminate()
+        server.wait()
+
+    for name, result in results.items():
+        print_result(name, result)
+
+    settings = {'storage': args.storage, 'workers': args.workers, 'concurrency': args.concurrency,
+                'requests': args.requests, 'runs': args.runs}
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({
+                'commit': subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip(),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'settings': settings,
+                'results': results,
+            }, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        # Numbers only compare on similar hardware and settings
+        if baseline['cpus'] != os.cpu_count() or baseline['settings'] != settings:
+            print(f'Baseline was measured with {baseline["cpus"]} cpus and {baseline["settings"]}, '
+                  f'save one on this machine with --save')
+
+        regressions = compare(results, baseline['results'], args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions against {baseline["commit"][:10]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import tracemalloc
+from io import BytesIO
+
+from app.config import UPLOAD_CHUNK_SIZE
+from app.storage import storage
+
+# Peak Python memory of one upload to MinIO (configured in .env), old buffered path against streaming:
+#   python -m benchmarks.upload_memory --size-mb 50
+
+
+def spooled_file(size: int):
+    # The same kind of file UploadFile gives to handlers, rolled over to disk
+    file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    block = os.urandom(1024 * 1024)
+    for _ in range(size // len(block)):
+        file.write(block)
+    file.write(block[:size % len(block)])
+    file.seek(0)
+    return file
+
+
+async def buffered_upload(bucket_name: str, file, size: int):
+    await storage.put_object(bucket_name, 'buffered.jpg', BytesIO(bytes(file.read())), -1,
+                             part_size=10 * 1024 * 1024)
+
+
+async def streamed_upload(bucket_name: str, file, size: int):
+    await storage.put_object(bucket_name, 'streamed.jpg', file, size,
+                             part_size=UPLOAD_CHUNK_SIZE, num_parallel_uploads=1)
+
+
+async def measure(upload, bucket_name: str, size: int) -> int:
+    with spooled_file(size) as file:
+        tracemalloc.start()
+        await upload(bucket_name, file, size)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return peak
+
+
+async def run(args):
+    size = args.size_mb * 1024 * 1024
+    if not await storage.bucket_exists(args.bucket):
+        await storage.make_bucket(args.bucket)
+
+    for name, upload in [('buffered', buffered_upload), ('streamed', streamed_upload)]:
+        peak = await measure(upload, args.bucket, size)
+        print(f'{name}: {args.size_mb} MiB file, peak {peak / 1024 / 1024:.1f} MiB')
+
+    for object_name in ['buffered.jpg', 'streamed.jpg']:
+        await storage.remove_object(args.bucket, object_name)
+    print(f'chunk size {UPLOAD_CHUNK_SIZE / 1024 / 1024:.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare peak memory of buffered and streamed uploads')
+    parser.add_argument('--size-mb', type=int, default=50)
+    parser.add_argument('--bucket', default='benchmark')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,103 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
+from datetime import datetime, timedelta
+
 from app.config import DATABASE_URL
-from app.models import Base
+from app.models import Base, Inbox
+from app.retention import default_partition_ddl, partition_ddl
+from app.storage import daily_bucket_name
 from app.config import config
 
 
+def migrate_timestamps(engine):
+    # created_at used to be a varchar holding str(datetime.utcnow()), it is converted in place to timestamptz
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            data_type = connection.execute(text(
+                "select data_type from information_schema.columns "
+                "where table_name = :table and column_name = 'created_at'"
+            ), {'table': table.name}).scalar()
+
+            if data_type == 'character varying':
+                connection.execute(text(
+                    f"alter table {table.name} "
+                    f"alter column created_at type timestamptz "
+                    f"using nullif(created_at, '')::timestamp at time zone 'UTC', "
+                    f"alter column created_at set default now()"
+                ))
+
+
+def partition_inbox(engine):
+    with engine.begin() as connection:
+        relkind = connection.execute(text("select relkind from pg_class where relname = 'inbox'")).scalar()
+
+        # inbox used to be a plain table, its rows are moved to a partitioned one
+        if relkind == 'r':
+            connection.execute(text('alter table inbox rename to inbox_unpartitioned'))
+            connection.execute(text('alter table inbox_unpartitioned drop constraint if exists inbox_pkey'))
+            for index in Inbox.__table__.indexes:
+                connection.execute(text(f'drop index if exists {index.name}'))
+            Inbox.__table__.create(connection)
+
+            days = connection.execute(text(
+                "select distinct left(request_code, 8) from inbox_unpartitioned where request_code ~ '^[0-9]{8}'"
+            )).scalars().all()
+            for day in days:
+                connection.execute(text(partition_ddl(day)))
+            connection.execute(text(default_partition_ddl()))
+
+            connection.execute(text(
+                'insert into inbox (request_code, file_name, created_at) '
+                'select request_code, file_name, created_at from inbox_unpartitioned'
+            ))
+            connection.execute(text('drop table inbox_unpartitioned'))
+
+        # Partitions of the next days are made by the running app
+        now = datetime.utcnow()
+        connection.execute(text(default_partition_ddl()))
+        for day in [daily_bucket_name(now), daily_bucket_name(now + timedelta(days=1))]:
+            connection.execute(text(partition_ddl(day)))
+
+
+def add_columns(engine):
+    # create_all skips tables which already exist, so columns added later are created here
+    with engine.begin() as connection:
+        connection.execute(text('alter table inbox add column if not exists blob_key varchar'))
+        connection.execute(text('alter table pending_upload add column if not exists user_id integer'))
+
+
+def check_duplicate_emails(engine):
+    # Signups used to check the email before insert without a constraint, so old databases can hold duplicates.
+    # Which of the accounts to keep is not decided here, the unique index can't be made until they are merged.
+    with engine.connect() as connection:
+        emails = connection.execute(text(
+            'select email from users group by email having count(*) > 1'
+        )).scalars().all()
+
+    if emails:
+        raise SystemExit(f'Several users have email {", ".join(emails)}, merge or remove them and run this again')
+
+
+def create_indexes(engine):
+    # create_all skips tables which already exist, so indexes added later are created here
+    with engine.begin() as connection:
+
+        # Only the newest token of a user is kept, older duplicates would break the unique index
+        connection.execute(text(
+            'delete from auth_token a using auth_token b where a.user_id = b.user_id and a.id < b.id'
+        ))
+
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        # Lookups by request_code use the primary key, which starts with it
+        connection.execute(text('drop index if exists ix_inbox_request_code'))
+
+
 def main():
     try:
         engine = create_engine(DATABASE_URL)
@@ -24,6 +114,11 @@ def main():
     finally:
         engine = create_engine(DATABASE_URL)
         Base.metadata.create_all(engine)
+        migrate_timestamps(engine)
+        partition_inbox(engine)
+        add_columns(engine)
+        check_duplicate_emails(engine)
+        create_indexes(engine)
 
 
 if __name__ == '__main__':
@@ -15,8 +15,11 @@ setup(
         'pytest-cov==3.0.0',
         'requests==2.27.1',
         'psycopg2-binary==2.9.3',
+        'asyncpg==0.25.0',
         'pydantic==1.9.1',
         'python-multipart==0.0.5',
+        'Pillow==9.1.1',
+        'prometheus-client==0.14.1',
         'starlette==0.19.1'
     ],
     scripts=['app/main.py', 'scripts/create_db.py']
@@ -0,0 +1,72 @@
+import hashlib
+import io
+import tarfile
+import zipfile
+from unittest import TestCase
+
+import anyio
+
+from app.archives import ArchiveError, BodyReader, read_archive
+
+
+def make_tar(files: dict, mode: str = 'w') -> bytes:
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode=mode) as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return output.getvalue()
+
+
+def make_zip(files: dict) -> bytes:
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w') as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return output.getvalue()
+
+
+def read_entries(data: bytes) -> list:
+    entries = []
+    read_archive(io.BytesIO(data), entries.append)
+    return [(entry.name, entry.file.read() if entry.file else None, entry.key) for entry in entries]
+
+
+FILES = {'frames/1.jpg': b'first', 'frames/2.JPG': b'second' * 1000, 'notes.txt': b'skipped'}
+EXPECTED = [
+    ('frames/1.jpg', b'first', hashlib.sha256(b'first').hexdigest()),
+    ('frames/2.JPG', b'second' * 1000, hashlib.sha256(b'second' * 1000).hexdigest()),
+    ('notes.txt', None, None),
+]
+
+
+class ReadArchiveTestCase(TestCase):
+
+    def test_tar(self):
+        self.assertEqual(read_entries(make_tar(FILES)), EXPECTED)
+
+    def test_compressed_tar(self):
+        self.assertEqual(read_entries(make_tar(FILES, 'w:gz')), EXPECTED)
+
+    def test_zip(self):
+        self.assertEqual(read_entries(make_zip(FILES)), EXPECTED)
+
+    def test_broken_archive(self):
+        with self.assertRaises(ArchiveError):
+            read_entries(make_tar(FILES)[:1000])
+
+    def test_body_is_read_in_chunks(self):
+        data = make_tar(FILES, 'w:gz')
+
+        async def chunks():
+            for start in range(0, len(data), 100):
+                yield data[start:start + 100]
+            yield b''
+
+        async def main():
+            entries = []
+            await anyio.to_thread.run_sync(read_archive, BodyReader(chunks()), entries.append)
+            return [(entry.name, entry.file.read() if entry.file else None, entry.key) for entry in entries]
+
+        self.assertEqual(anyio.run(main), EXPECTED)
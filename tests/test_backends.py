@@ -0,0 +1,103 @@
+import io
+import tempfile
+from datetime import timedelta
+from unittest import TestCase
+from urllib.parse import parse_qs, urlsplit
+
+from app.backends import LocalBackend, MemoryBackend, StorageError, check_signature
+
+
+class BackendTests:
+    # Contract every storage backend has to keep, tests of concrete backends make self.backend in setUp
+
+    def test_put_stat_get(self):
+        self.backend.make_bucket('20220101')
+        self.backend.put_object('20220101', 'image.jpg', io.BytesIO(b'0123456789'), 10)
+
+        self.assertEqual(self.backend.stat_object('20220101', 'image.jpg').size, 10)
+        self.assertEqual(self.backend.list_objects('20220101'), ['image.jpg'])
+
+        response = self.backend.get_object('20220101', 'image.jpg', 2, 5)
+        self.assertEqual(response.read(3) + response.read(100), b'23456')
+        response.close()
+
+    def test_etag_changes_with_content(self):
+        self.backend.make_bucket('20220101')
+        self.backend.put_object('20220101', 'image.jpg', io.BytesIO(b'first'), 5)
+        etag = self.backend.stat_object('20220101', 'image.jpg').etag
+
+        self.backend.put_object('20220101', 'image.jpg', io.BytesIO(b'second'), 6)
+
+        self.assertNotEqual(self.backend.stat_object('20220101', 'image.jpg').etag, etag)
+
+    def test_put_from_file(self):
+        self.backend.make_bucket('20220101')
+
+        with tempfile.TemporaryFile() as file:
+            file.write(b'0123456789')
+            file.seek(2)
+            self.backend.put_object('20220101', 'image.jpg', file, 5)
+            self.assertEqual(file.tell(), 7)
+
+        self.assertEqual(self.backend.get_object('20220101', 'image.jpg').read(100), b'23456')
+
+    def test_missing_bucket_and_object(self):
+        with self.assertRaises(StorageError) as error:
+            self.backend.put_object('20220101', 'image.jpg', io.BytesIO(b'0'), 1)
+        self.assertEqual(error.exception.code, 'NoSuchBucket')
+
+        self.backend.make_bucket('20220101')
+        with self.assertRaises(StorageError) as error:
+            self.backend.stat_object('20220101', 'image.jpg')
+        self.assertEqual(error.exception.code, 'NoSuchKey')
+
+        with self.assertRaises(StorageError) as error:
+            self.backend.make_bucket('20220101')
+        self.assertEqual(error.exception.code, 'BucketAlreadyOwnedByYou')
+
+    def test_remove_objects_and_bucket(self):
+        self.backend.make_bucket('20220101')
+        for name in ['a.jpg', 'b.jpg']:
+            self.backend.put_object('20220101', name, io.BytesIO(b'0'), 1)
+
+        with self.assertRaises(StorageError) as error:
+            self.backend.remove_bucket('20220101')
+        self.assertEqual(error.exception.code, 'BucketNotEmpty')
+
+        self.assertEqual(self.backend.remove_objects('20220101', ['a.jpg', 'b.jpg', 'missing.jpg']), [])
+        self.backend.remove_bucket('20220101')
+
+        self.assertFalse(self.backend.bucket_exists('20220101'))
+        self.assertEqual(self.backend.list_buckets(), [])
+
+    def test_presigned_url_is_signed(self):
+        url = urlsplit(self.backend.presigned_put_url('20220101', 'image.jpg', timedelta(minutes=1)))
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+
+        self.assertEqual(url.path, '/storage/20220101/image.jpg')
+        self.assertTrue(check_signature('PUT', '20220101', 'image.jpg', int(query['expires']), query['signature']))
+        self.assertFalse(check_signature('GET', '20220101', 'image.jpg', int(query['expires']), query['signature']))
+        self.assertFalse(check_signature('PUT', '20220101', 'other.jpg', int(query['expires']), query['signature']))
+
+
+class LocalBackendTestCase(BackendTests, TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.backend = LocalBackend(directory.name)
+
+    def test_names_stay_inside_root(self):
+        with self.assertRaises(StorageError) as error:
+            self.backend.bucket_exists('..')
+        self.assertEqual(error.exception.code, 'InvalidObjectName')
+
+        self.backend.make_bucket('20220101')
+        with self.assertRaises(StorageError):
+            self.backend.put_object('20220101', '../image.jpg', io.BytesIO(b'0'), 1)
+
+
+class MemoryBackendTestCase(BackendTests, TestCase):
+
+    def setUp(self) -> None:
+        self.backend = MemoryBackend()
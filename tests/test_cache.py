@@ -0,0 +1,43 @@
+import time
+from unittest import TestCase
+
+from app.cache import TTLCache
+
+
+class TTLCacheTestCase(TestCase):
+
+    def test_get_set(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('token', 1)
+
+        self.assertEqual(cache.get('token'), 1)
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('first', 1)
+        cache.set('second', 2)
+        cache.get('first')
+        cache.set('third', 3)
+
+        self.assertEqual(cache.get('first'), 1)
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expired_entry_is_dropped(self):
+        cache = TTLCache(maxsize=2, ttl=0.01)
+        cache.set('token', 1)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_pop(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('token', 1)
+
+        self.assertEqual(cache.pop('token'), 1)
+        self.assertIsNone(cache.get('token'))
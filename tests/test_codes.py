@@ -0,0 +1,42 @@
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from app.codes import RequestCodeGenerator
+from app.storage import daily_bucket_name
+
+
+def make_codes(count: int, node_id: int = 1) -> list:
+    generator = RequestCodeGenerator(node_id)
+    return [generator.new()[0] for _ in range(count)]
+
+
+class RequestCodeTestCase(TestCase):
+
+    def test_code_starts_with_bucket_name(self):
+        code, moment = RequestCodeGenerator(1).new()
+
+        self.assertEqual(code[:8], daily_bucket_name(moment))
+        self.assertEqual(len(code), 33)
+
+    def test_codes_of_one_process_are_sorted(self):
+        codes = make_codes(100000)
+
+        self.assertEqual(codes, sorted(codes))
+        self.assertEqual(len(set(codes)), len(codes))
+
+    def test_no_collisions_between_threads(self):
+        generator = RequestCodeGenerator(1)
+
+        with ThreadPoolExecutor(16) as executor:
+            codes = list(executor.map(lambda _: generator.new()[0], range(100000)))
+
+        self.assertEqual(len(set(codes)), len(codes))
+
+    def test_no_collisions_between_processes_and_nodes(self):
+        # Worker processes of one node share the node id, other nodes have other ids
+        with multiprocessing.get_context('spawn').Pool(4) as pool:
+            codes = sum(pool.map(make_codes, [50000] * 4), [])
+        codes += make_codes(50000, node_id=2)
+
+        self.assertEqual(len(set(codes)), len(codes))
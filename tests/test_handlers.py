@@ -1,38 +1,69 @@
-from datetime import datetime
+import io
+import os
+import tarfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from unittest import TestCase
+from unittest.mock import patch
 from uuid import uuid4
 
+import requests
 from fastapi.testclient import TestClient
 
-from app.utils import get_password_hash
+from app.backends import StorageError
+from app.config import DERIVATIVE_SIZES, PASSWORD_HASH_ALGORITHM
+from app.utils import HASHERS, get_password_hash, verify
+from app.handlers import format_time, images_cache
 from app.main import app
-from app.models import connect_db, User, AuthToken, Inbox, minio_client
+from app.metrics import recorded_requests
+from app.models import SessionLocal, User, AuthToken, Inbox, Ingest, PendingUpload, Blob
+from app.storage import storage
 
 
-class CreateUserTestCase(TestCase):
+class QueryBudgetMixin:
+
+    @contextmanager
+    def assertMaxQueries(self, budget: int):
+        # Every request made in the block must run at most budget queries and no statement twice
+        with recorded_requests() as recorded:
+            yield
+
+        self.assertTrue(recorded, 'No requests were made')
+        for route, timings in recorded:
+            statements = '\n'.join(timings.statements)
+            self.assertLessEqual(timings.db_queries, budget, f'{route} ran {timings.db_queries} queries:\n{statements}')
+            self.assertEqual(timings.repeated_statements(), {}, f'{route} repeated statements:\n{statements}')
+
+
+class CreateUserTestCase(QueryBudgetMixin, TestCase):
 
     def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
         self.client = TestClient(app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
 
     def test_main_url(self):
         response = self.client.get('/')
         self.assertEqual(response.status_code, 200)
 
     def test_create_user_valid(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_exist = database.query(User).filter(User.email == 'test@test.com').one_or_none()
         if user_exist:
             database.query(User).filter(User.email == 'test@test.com').delete()
             database.commit()
 
-        response = self.client.post('/user', json={"user": {
-            "email": "test@test.com",
-            "password": get_password_hash('123'),
-            "first_name": "test",
-            "last_name": "test_user",
-            "nickname": "test_nick"
-        }})
+        with self.assertMaxQueries(2):
+            response = self.client.post('/user', json={"user": {
+                "email": "test@test.com",
+                "password": get_password_hash('123'),
+                "first_name": "test",
+                "last_name": "test_user",
+                "nickname": "test_nick"
+            }})
 
         user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
 
@@ -43,7 +74,7 @@ class CreateUserTestCase(TestCase):
         database.commit()
 
     def test_create_user_group_admin(self):
-        database = connect_db()
+        database = SessionLocal()
 
         response = self.client.post('/user', json={"user": {
             "email": "admin@test.com",
@@ -62,7 +93,7 @@ class CreateUserTestCase(TestCase):
         database.commit()
 
     def test_create_user_group_moderator(self):
-        database = connect_db()
+        database = SessionLocal()
 
         response = self.client.post('/user', json={"user": {
             "email": "moder@test.com",
@@ -81,7 +112,7 @@ class CreateUserTestCase(TestCase):
         database.commit()
 
     def test_create_user_invalid(self):
-        database = connect_db()
+        database = SessionLocal()
 
         new_user = User(
             email='test@test.com',
@@ -110,17 +141,21 @@ class CreateUserTestCase(TestCase):
         database.commit()
 
 
-class LoginUserTestCase(TestCase):
+class LoginUserTestCase(QueryBudgetMixin, TestCase):
 
     def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
         self.client = TestClient(app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
 
-        database = connect_db()
+        database = SessionLocal()
 
+        # Hashed with the current settings, so a login doesn't hash it again
         new_user = User(
             email='test@test.com',
             group='user',
-            password=get_password_hash('123'),
+            password=HASHERS[PASSWORD_HASH_ALGORITHM].hash('123'),
             first_name='test',
             last_name='test',
             nickname='test',
@@ -130,7 +165,7 @@ class LoginUserTestCase(TestCase):
         database.commit()
 
     def tearDown(self) -> None:
-        database = connect_db()
+        database = SessionLocal()
 
         database.query(User).filter(User.email == 'test@test.com').delete()
         database.commit()
@@ -154,12 +189,13 @@ class LoginUserTestCase(TestCase):
         self.assertEqual(response.json(), {'detail': 'Email/password invalid'})
 
     def test_user_login_valid(self):
-        database = connect_db()
+        database = SessionLocal()
 
-        response = self.client.post('/login', json={"user_form": {
-            "email": "test@test.com",
-            "password": '123'
-        }})
+        with self.assertMaxQueries(2):
+            response = self.client.post('/login', json={"user_form": {
+                "email": "test@test.com",
+                "password": '123'
+            }})
 
         user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
         auth_token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
@@ -169,8 +205,31 @@ class LoginUserTestCase(TestCase):
         database.query(AuthToken).filter(AuthToken.user_id == user_id).delete()
         database.commit()
 
+    def test_user_login_rehashes_old_password(self):
+        database = SessionLocal()
+
+        user = database.query(User).filter(User.email == 'test@test.com').one_or_none()
+        user.password = get_password_hash('123')
+        database.commit()
+
+        # The old sha256 hash is replaced by one more query
+        with self.assertMaxQueries(3):
+            response = self.client.post('/login', json={"user_form": {
+                "email": "test@test.com",
+                "password": '123'
+            }})
+
+        database.expire_all()
+        password = database.query(User).filter(User.email == 'test@test.com').one_or_none().password
+        database.query(AuthToken).filter(AuthToken.user_id == user.id).delete()
+        database.commit()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(password.startswith(PASSWORD_HASH_ALGORITHM + '$'))
+        self.assertEqual(verify('123', password), (True, False))
+
     def test_user_login_token_already_exist(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
 
@@ -195,12 +254,38 @@ class LoginUserTestCase(TestCase):
         database.query(AuthToken).filter(AuthToken.user_id == user_id).delete()
         database.commit()
 
+    def test_user_login_twice_keeps_one_token(self):
+        database = SessionLocal()
 
-class GetImagesTestCase(TestCase):
+        first = self.client.post('/login', json={"user_form": {
+            "email": "test@test.com",
+            "password": '123'
+        }}).json()['Auth Token']
+        second = self.client.post('/login', json={"user_form": {
+            "email": "test@test.com",
+            "password": '123'
+        }}).json()['Auth Token']
+
+        user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
+        tokens = database.query(AuthToken).filter(AuthToken.user_id == user_id).all()
+
+        self.assertNotEqual(first, second)
+        self.assertEqual([token.token for token in tokens], [second])
+
+        database.query(AuthToken).filter(AuthToken.user_id == user_id).delete()
+        database.commit()
+
+
+class GetImagesTestCase(QueryBudgetMixin, TestCase):
 
     def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
         self.client = TestClient(app)
-        database = connect_db()
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+        # Rows of the code are replaced in every test behind the cache
+        images_cache.clear()
+        database = SessionLocal()
 
         new_user = User(
             email='test@test.com',
@@ -229,7 +314,7 @@ class GetImagesTestCase(TestCase):
         database.commit()
 
     def tearDown(self) -> None:
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
 
@@ -239,18 +324,20 @@ class GetImagesTestCase(TestCase):
         database.commit()
 
     def test_get_images_valid_token_valid_code(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
         token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
         images = database.query(Inbox).filter(Inbox.request_code == '12345').all()
         code = '12345'
 
-        response = self.client.get(f'/frames/{token}/{code}')
+        with self.assertMaxQueries(2):
+            response = self.client.get(f'/frames/{token}/{code}')
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(),
-                         {code: [{'file_name': image.file_name, 'created_at': image.created_at} for image in images]})
+                         {code: [{'file_name': image.file_name, 'created_at': format_time(image.created_at),
+                                  'sizes': DERIVATIVE_SIZES} for image in images]})
 
     def test_get_images_invalid_token(self):
         code = '12345'
@@ -260,7 +347,7 @@ class GetImagesTestCase(TestCase):
         self.assertEqual(response.json(), {'detail': 'AuthToken dont exist'})
 
     def test_get_images_valid_token_invalid_code(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
         token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
@@ -271,12 +358,142 @@ class GetImagesTestCase(TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json(), {'detail': f'Images with code {code} doesnt exist'})
 
+    def test_get_images_not_modified(self):
+        database = SessionLocal()
 
-class DeleteImagesTestCase(TestCase):
+        user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
+        token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
+        code = '12345'
+
+        etag = self.client.get(f'/frames/{token}/{code}').headers['etag']
+        response = self.client.get(f'/frames/{token}/{code}', headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['etag'], etag)
+
+    def test_get_images_of_running_ingest_are_not_cached(self):
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
+        token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
+        code = '12345'
+
+        ingest = Ingest(request_code=code, user_id=user_id, status='running', stored=1, skipped=0)
+        database.add(ingest)
+        database.commit()
+        self.addCleanup(lambda: (database.query(Ingest).filter(Ingest.request_code == code).delete(),
+                                 database.commit()))
+
+        # Batches committed while the ingest runs show up on the next request
+        first = self.client.get(f'/frames/{token}/{code}')
+        database.add(Inbox(request_code=code, file_name=str(uuid4())))
+        database.commit()
+        second = self.client.get(f'/frames/{token}/{code}')
+
+        # Once it is done the list is cached again
+        ingest.status = 'done'
+        database.commit()
+        third = self.client.get(f'/frames/{token}/{code}')
+        database.add(Inbox(request_code=code, file_name=str(uuid4())))
+        database.commit()
+        fourth = self.client.get(f'/frames/{token}/{code}')
+
+        self.assertEqual([len(response.json()[code]) for response in [first, second, third, fourth]], [1, 2, 2, 2])
+        self.assertNotEqual(first.headers['etag'], second.headers['etag'])
+        self.assertEqual(third.headers['etag'], fourth.headers['etag'])
+
+
+class ListCodesTestCase(QueryBudgetMixin, TestCase):
 
     def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
         self.client = TestClient(app)
-        database = connect_db()
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+        database = SessionLocal()
+
+        new_user = User(
+            email='test@test.com',
+            group='user',
+            password=get_password_hash('123'),
+            first_name='test',
+            last_name='test',
+            nickname='test',
+        )
+
+        database.add(new_user)
+        database.commit()
+
+        auth_token = AuthToken(token=str(uuid4()), user_id=new_user.id)
+        database.add(auth_token)
+        database.commit()
+        self.token = auth_token.token
+
+        # Five codes in a day no other test uses, the second and third at the same time
+        self.codes = [f'200101010000{number:08}' for number in range(5)]
+        self.times = [datetime(2001, 1, 1, 0, minute, tzinfo=timezone.utc) for minute in [0, 1, 1, 2, 3]]
+        for request_code, created_at in zip(self.codes, self.times):
+            database.add(Inbox(request_code=request_code, file_name=str(uuid4()), created_at=created_at))
+        database.add(Inbox(request_code=self.codes[0], file_name=str(uuid4()), created_at=self.times[0]))
+        database.commit()
+
+    def tearDown(self) -> None:
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
+
+        database.query(AuthToken).filter(AuthToken.user_id == user_id).delete()
+        database.query(User).filter(User.id == user_id).delete()
+        database.query(Inbox).filter(Inbox.request_code.in_(self.codes)).delete()
+        database.commit()
+
+    def list_codes(self, **params):
+        return self.client.get(f'/frames/{self.token}', params={'from': '2001-01-01T00:00:00',
+                                                                  'to': '2001-01-02T00:00:00', **params})
+
+    def test_list_codes_pages(self):
+        codes = []
+        after = None
+        pages = 0
+        while True:
+            with self.assertMaxQueries(2):
+                response = self.list_codes(limit=2, **({'after': after} if after else {}))
+            self.assertEqual(response.status_code, 200)
+
+            codes += response.json()['codes']
+            after = response.json()['after']
+            pages += 1
+            if after is None:
+                break
+
+        # Every code once, in upload order, also the ones which share a time across a page boundary
+        self.assertEqual(pages, 3)
+        self.assertEqual([code['request_code'] for code in codes], self.codes)
+        self.assertEqual([code['images'] for code in codes], [2, 1, 1, 1, 1])
+        self.assertEqual([code['created_at'] for code in codes], [format_time(moment) for moment in self.times])
+
+    def test_list_codes_from_to(self):
+        response = self.list_codes(**{'from': '2001-01-01T00:01:00', 'to': '2001-01-01T00:02:00'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([code['request_code'] for code in response.json()['codes']], self.codes[1:3])
+        self.assertIsNone(response.json()['after'])
+
+    def test_list_codes_invalid_cursor(self):
+        response = self.list_codes(after='not-a-cursor')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'detail': 'Invalid cursor'})
+
+
+class DeleteImagesTestCase(QueryBudgetMixin, TestCase):
+
+    def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
+        self.client = TestClient(app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+        database = SessionLocal()
 
         new_user = User(
             email='admintest@test.com',
@@ -307,13 +524,14 @@ class DeleteImagesTestCase(TestCase):
         database.commit()
 
         bucket_name = request_code[:8]
-        if not minio_client.bucket_exists(bucket_name):
-            minio_client.make_bucket(bucket_name)
+        if not storage.client.bucket_exists(bucket_name):
+            storage.client.make_bucket(bucket_name)
 
-        minio_client.fput_object(bucket_name, file_name + '.jpg', 'tests/images_for_test/testimage.jpg')
+        with open('tests/images_for_test/testimage.jpg', 'rb') as image:
+            storage.client.put_object(bucket_name, file_name + '.jpg', image, os.path.getsize(image.name))
 
     def tearDown(self) -> None:
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
 
@@ -326,21 +544,71 @@ class DeleteImagesTestCase(TestCase):
 
         if image:
             database.query(Inbox).filter(Inbox.file_name == 'test_image').delete()
-            minio_client.remove_object(image.request_code[:8], 'test_image.jpg')
+            storage.client.remove_object(image.request_code[:8], 'test_image.jpg')
             database.commit()
 
     def test_delete_images_valid_data(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
         token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
         request_code = database.query(Inbox).filter(Inbox.file_name == 'test_image').one_or_none().request_code
 
-        response = self.client.delete(f'/frames/{token}/{request_code}')
+        with self.assertMaxQueries(3):
+            response = self.client.delete(f'/frames/{token}/{request_code}')
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), f'Images with code {request_code} was deleted')
 
+    def test_delete_images_clears_cached_images(self):
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
+        token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
+        request_code = database.query(Inbox).filter(Inbox.file_name == 'test_image').one_or_none().request_code
+
+        self.assertEqual(self.client.get(f'/frames/{token}/{request_code}').status_code, 200)
+        self.client.delete(f'/frames/{token}/{request_code}')
+        response = self.client.get(f'/frames/{token}/{request_code}')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_delete_images_partial_failure(self):
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
+        token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
+        request_code = database.query(Inbox).filter(Inbox.file_name == 'test_image').one_or_none().request_code
+
+        database.add(Inbox(request_code=request_code, file_name='kept_image'))
+        database.commit()
+        self.addCleanup(lambda: (database.query(Inbox).filter(Inbox.file_name == 'kept_image').delete(),
+                                 database.commit()))
+
+        remove_objects = storage.client.remove_objects
+
+        def refusing_remove_objects(bucket_name, object_names):
+            # The storage refuses one object, the others are removed
+            errors = remove_objects(bucket_name, [name for name in object_names if name != 'kept_image.jpg'])
+            return errors + [StorageError('AccessDenied', 'Access denied', 'kept_image.jpg')]
+
+        with patch.object(storage.client, 'remove_objects', refusing_remove_objects):
+            response = self.client.delete(f'/frames/{token}/{request_code}')
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.json(), {
+            'detail': f'Images with code {request_code} was partially deleted',
+            'errors': [{'file_name': 'kept_image', 'object_name': 'kept_image.jpg', 'code': 'AccessDenied',
+                        'message': 'Access denied'}],
+        })
+
+        # Only the row of the removed object is deleted
+        database.expire_all()
+        images = database.query(Inbox).filter(Inbox.request_code == request_code).all()
+        self.assertEqual([image.file_name for image in images], ['kept_image'])
+        with self.assertRaises(StorageError):
+            storage.client.stat_object(request_code[:8], 'test_image.jpg')
+
     def test_delete_images_invalid_token(self):
 
         token = 'not_valid_token'
@@ -352,7 +620,7 @@ class DeleteImagesTestCase(TestCase):
         self.assertEqual(response.json(), {'detail': 'AuthToken dont exist'})
 
     def test_delete_images_valid_token_invalid_group(self):
-        database = connect_db()
+        database = SessionLocal()
 
         new_user = User(
             email='test@test.com',
@@ -389,7 +657,7 @@ class DeleteImagesTestCase(TestCase):
         database.commit()
 
     def test_delete_images_valid_token_valid_group_invalid_code(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
         token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
@@ -401,11 +669,14 @@ class DeleteImagesTestCase(TestCase):
         self.assertEqual(response.json(), {'detail': f'Images with code {request_code} doesnt exist'})
 
 
-class UploadImagesTestCase(TestCase):
+class UploadImagesTestCase(QueryBudgetMixin, TestCase):
 
     def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
         self.client = TestClient(app)
-        database = connect_db()
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+        database = SessionLocal()
 
         new_user = User(
             email='admintest@test.com',
@@ -426,7 +697,7 @@ class UploadImagesTestCase(TestCase):
         database.commit()
 
     def tearDown(self) -> None:
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
 
@@ -436,31 +707,126 @@ class UploadImagesTestCase(TestCase):
         database.commit()
 
     def test_upload_images_valid_data(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
         token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
 
-        with open('tests/images_for_test/testimage.jpg', 'rb') as image:
-            response = self.client.post(f'/frames/{token}', files={'files': ('testimage.jpg', image, 'image/jpeg')})
-            request_code = str(datetime.utcnow()).replace(':', '').replace('-', '').replace(' ', '').replace('.', '')[
-                           :-6]
-            bucket_name = request_code[:8]
+        # Rows of all images are inserted by one statement, their content by another one
+        with open('tests/images_for_test/testimage.jpg', 'rb') as image, open('tests/images_for_test/1.jpg',
+                                                                               'rb') as other_image:
+            with self.assertMaxQueries(3):
+                response = self.client.post(f'/frames/{token}', files=[
+                    ('files', ('testimage.jpg', image, 'image/jpeg')),
+                    ('files', ('1.jpg', other_image, 'image/jpeg')),
+                ])
+        request_code = next(iter(response.json()))
+        bucket_name = request_code[:8]
 
         images = database.query(Inbox).filter(Inbox.request_code == request_code).all()
         assert_response = {request_code: []}
 
         for image in images:
             assert_response[request_code].append(
-                {'file_name': image.file_name, 'created_at': image.created_at})
-            minio_client.remove_object(bucket_name, image.file_name+'.jpg')
+                {'file_name': image.file_name, 'created_at': format_time(image.created_at)})
+            storage.client.remove_object(bucket_name, image.blob_key+'.jpg')
 
+        database.query(Blob).filter(Blob.bucket_name == bucket_name,
+                                    Blob.key.in_([image.blob_key for image in images])).delete()
         database.query(Inbox).filter(Inbox.request_code == request_code).delete()
         database.commit()
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), assert_response)
 
+    def test_upload_images_keeps_order(self):
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
+        token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
+
+        # Files are put in parallel, the response still lists them in the order they were sent
+        contents = [os.urandom(1024 * (number + 1)) for number in range(5)]
+        response = self.client.post(f'/frames/{token}', files=[
+            ('files', (f'{number}.jpg', data, 'image/jpeg')) for number, data in enumerate(contents)
+        ])
+        request_code = next(iter(response.json()))
+
+        downloads = [self.client.get(f'/frames/{token}/{request_code}/{image["file_name"]}').content
+                     for image in response.json()[request_code]]
+        self.assertEqual(self.client.delete(f'/frames/{token}/{request_code}').status_code, 200)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(downloads, contents)
+
+    def test_upload_same_image_stores_it_once(self):
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
+        token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
+
+        # Random bytes, so no other test has the same content in the bucket
+        data = os.urandom(1024)
+        codes = []
+        for _ in range(2):
+            response = self.client.post(f'/frames/{token}', files=[
+                ('files', ('first.jpg', data, 'image/jpeg')),
+                ('files', ('second.jpg', data, 'image/jpeg')),
+            ])
+            codes.append(next(iter(response.json())))
+        bucket_name = codes[0][:8]
+
+        keys = {image.blob_key for image in database.query(Inbox).filter(Inbox.request_code.in_(codes)).all()}
+        self.assertEqual(len(keys), 1)
+        key = keys.pop()
+        self.assertEqual(database.query(Blob).filter(Blob.bucket_name == bucket_name, Blob.key == key).one().ref_count,
+                         4)
+
+        # The object stays while another code refers to it
+        self.assertEqual(self.client.delete(f'/frames/{token}/{codes[0]}').status_code, 200)
+        self.assertEqual(storage.client.stat_object(bucket_name, key + '.jpg').size, len(data))
+        database.expire_all()
+        self.assertEqual(database.query(Blob).filter(Blob.bucket_name == bucket_name, Blob.key == key).one().ref_count,
+                         2)
+
+        self.assertEqual(self.client.delete(f'/frames/{token}/{codes[1]}').status_code, 200)
+        self.assertIsNone(database.query(Blob).filter(Blob.bucket_name == bucket_name, Blob.key == key).one_or_none())
+        with self.assertRaises(StorageError):
+            storage.client.stat_object(bucket_name, key + '.jpg')
+
+    def test_upload_images_in_background(self):
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
+        token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
+
+        data = os.urandom(1024)
+        response = self.client.post(f'/frames/{token}?background=true',
+                                    files=[('files', ('first.jpg', data, 'image/jpeg'))])
+        request_code = next(iter(response.json()))
+
+        # Wait until workers save the image
+        for _ in range(100):
+            upload_status = self.client.get(f'/frames/{token}/{request_code}/status').json()
+            if upload_status['status'] not in ['queued', 'running']:
+                break
+            time.sleep(0.05)
+
+        images = database.query(Inbox).filter(Inbox.request_code == request_code).all()
+        bucket_name = request_code[:8]
+        download = self.client.get(f'/frames/{token}/{request_code}/{images[0].file_name}')
+
+        storage.client.remove_object(bucket_name, images[0].blob_key + '.jpg')
+        database.query(Blob).filter(Blob.bucket_name == bucket_name, Blob.key == images[0].blob_key).delete()
+        database.query(Inbox).filter(Inbox.request_code == request_code).delete()
+        database.query(Ingest).filter(Ingest.request_code == request_code).delete()
+        database.commit()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()[request_code][0]['file_name'], images[0].file_name)
+        self.assertEqual((upload_status['status'], upload_status['stored']), ('done', 1))
+        self.assertEqual(download.content, data)
+
     def test_upload_images_invalid_token(self):
         token = 'some_invalid_token'
         with open('tests/images_for_test/testimage.jpg', 'rb') as image:
@@ -470,7 +836,7 @@ class UploadImagesTestCase(TestCase):
         self.assertEqual(response.json(), {'detail': 'AuthToken dont exist'})
 
     def test_upload_images_valid_token_invalid_group(self):
-        database = connect_db()
+        database = SessionLocal()
 
         new_user = User(
             email='test@test.com',
@@ -507,7 +873,7 @@ class UploadImagesTestCase(TestCase):
         self.assertEqual(response.json(), {'detail': 'You must be admin/moderator'})
 
     def test_upload_images_invalid_format(self):
-        database = connect_db()
+        database = SessionLocal()
 
         user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
         token = database.query(AuthToken).filter(AuthToken.user_id == user_id).one_or_none().token
@@ -517,3 +883,307 @@ class UploadImagesTestCase(TestCase):
 
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json(), {'detail': 'All images must be in format .jpg'})
+
+
+class UploadArchiveTestCase(TestCase):
+
+    def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
+        self.client = TestClient(app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+        database = SessionLocal()
+
+        new_user = User(
+            email='admintest@test.com',
+            group='admin',
+            password=get_password_hash('123'),
+            first_name='test',
+            last_name='test',
+            nickname='test',
+        )
+
+        database.add(new_user)
+        database.commit()
+
+        auth_token = AuthToken(token=str(uuid4()), user_id=new_user.id)
+        database.add(auth_token)
+        database.commit()
+
+        self.user_id = new_user.id
+        self.token = auth_token.token
+
+        # Random content, so no other test has the same images in the bucket
+        self.frames = [os.urandom(1024) for _ in range(2)]
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for name, data in [('1.jpg', self.frames[0]), ('2.jpg', self.frames[1]), ('3.jpg', self.frames[0]),
+                               ('notes.txt', b'not an image')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        self.archive = archive.getvalue()
+
+    def tearDown(self) -> None:
+        database = SessionLocal()
+
+        for ingest in database.query(Ingest).filter(Ingest.user_id == self.user_id).all():
+            bucket_name = ingest.request_code[:8]
+            images = database.query(Inbox).filter(Inbox.request_code == ingest.request_code).all()
+            for key in {image.blob_key for image in images}:
+                storage.client.remove_object(bucket_name, key + '.jpg')
+                database.query(Blob).filter(Blob.bucket_name == bucket_name, Blob.key == key).delete()
+            database.query(Inbox).filter(Inbox.request_code == ingest.request_code).delete()
+        database.query(Ingest).filter(Ingest.user_id == self.user_id).delete()
+
+        database.query(AuthToken).filter(AuthToken.user_id == self.user_id).delete()
+        database.query(User).filter(User.id == self.user_id).delete()
+        database.commit()
+
+    def test_upload_archive(self):
+        database = SessionLocal()
+
+        response = self.client.post(f'/frames/{self.token}/archive', data=self.archive)
+        request_code = response.json()['request_code']
+        images = database.query(Inbox).filter(Inbox.request_code == request_code).all()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()['status'], response.json()['stored'], response.json()['skipped']),
+                         ('done', 3, 1))
+        self.assertEqual(len(images), 3)
+        self.assertEqual(len({image.blob_key for image in images}), 2)
+        self.assertEqual(self.client.get(f'/frames/{self.token}/archive/{request_code}').json(), response.json())
+
+    def test_upload_broken_archive(self):
+        response = self.client.post(f'/frames/{self.token}/archive', data=self.archive[:-100])
+        archives = self.client.get(f'/frames/{self.token}/archive').json()['archives']
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([archive['status'] for archive in archives], ['failed'])
+
+
+class DownloadImageTestCase(QueryBudgetMixin, TestCase):
+
+    def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
+        self.client = TestClient(app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+        database = SessionLocal()
+
+        new_user = User(
+            email='test@test.com',
+            group='user',
+            password=get_password_hash('123'),
+            first_name='test',
+            last_name='test',
+            nickname='test',
+        )
+
+        database.add(new_user)
+        database.commit()
+
+        auth_token = AuthToken(token=str(uuid4()), user_id=new_user.id)
+        database.add(auth_token)
+        database.commit()
+
+        self.token = auth_token.token
+        self.request_code = str(datetime.utcnow()).replace(':', '').replace('-', '').replace(' ', '').replace('.', '')
+        new_image = Inbox(
+            request_code=self.request_code,
+            file_name='test_image'
+        )
+
+        database.add(new_image)
+        database.commit()
+
+        bucket_name = self.request_code[:8]
+        if not storage.client.bucket_exists(bucket_name):
+            storage.client.make_bucket(bucket_name)
+
+        with open('tests/images_for_test/testimage.jpg', 'rb') as image:
+            storage.client.put_object(bucket_name, 'test_image.jpg', image, os.path.getsize(image.name))
+
+        with open('tests/images_for_test/testimage.jpg', 'rb') as image:
+            self.image = image.read()
+
+    def tearDown(self) -> None:
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'test@test.com').one_or_none().id
+
+        database.query(AuthToken).filter(AuthToken.user_id == user_id).delete()
+        database.query(User).filter(User.id == user_id).delete()
+        database.query(Inbox).filter(Inbox.file_name == 'test_image').delete()
+        database.commit()
+
+        storage.client.remove_object(self.request_code[:8], 'test_image.jpg')
+
+    def test_download_image(self):
+        with self.assertMaxQueries(2):
+            response = self.client.get(f'/frames/{self.token}/{self.request_code}/test_image')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.image)
+        self.assertIn('etag', response.headers)
+
+    def test_download_image_range(self):
+        response = self.client.get(f'/frames/{self.token}/{self.request_code}/test_image',
+                                   headers={'Range': 'bytes=10-19'})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.image[10:20])
+        self.assertEqual(response.headers['content-range'], f'bytes 10-19/{len(self.image)}')
+
+    def test_download_image_not_modified(self):
+        etag = self.client.get(f'/frames/{self.token}/{self.request_code}/test_image').headers['etag']
+
+        response = self.client.get(f'/frames/{self.token}/{self.request_code}/test_image',
+                                   headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_missing_derivative_is_made_on_download(self):
+        size = DERIVATIVE_SIZES[0]
+        for made in DERIVATIVE_SIZES:
+            self.addCleanup(storage.client.remove_object, self.request_code[:8], f'test_image_{made}.jpg')
+
+        response = self.client.get(f'/frames/{self.token}/{self.request_code}/test_image?size={size}')
+        self.assertEqual(response.status_code, 404)
+
+        # The download queued the image again, smaller copies are made in background
+        for _ in range(100):
+            response = self.client.get(f'/frames/{self.token}/{self.request_code}/test_image?size={size}')
+            if response.status_code == 200:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['content-type'], 'image/jpeg')
+
+    def test_download_image_invalid_code(self):
+        response = self.client.get(f'/frames/{self.token}/invalid_code/test_image')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'detail': 'Image test_image with code invalid_code doesnt exist'})
+
+
+class DirectUploadTestCase(QueryBudgetMixin, TestCase):
+
+    def setUp(self) -> None:
+        # Keep one event loop for the whole test, pooled async connections are bound to it
+        self.client = TestClient(app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+        database = SessionLocal()
+
+        new_user = User(
+            email='admintest@test.com',
+            group='admin',
+            password=get_password_hash('123'),
+            first_name='test',
+            last_name='test',
+            nickname='test',
+        )
+
+        database.add(new_user)
+        database.commit()
+
+        auth_token = AuthToken(token=str(uuid4()), user_id=new_user.id)
+        database.add(auth_token)
+        database.commit()
+
+        self.token = auth_token.token
+
+    def tearDown(self) -> None:
+        database = SessionLocal()
+
+        user_id = database.query(User).filter(User.email == 'admintest@test.com').one_or_none().id
+
+        database.query(AuthToken).filter(AuthToken.user_id == user_id).delete()
+        database.query(User).filter(User.id == user_id).delete()
+        database.commit()
+
+    def test_initiate_and_commit_upload(self):
+        database = SessionLocal()
+
+        response = self.client.post(f'/frames/{self.token}/initiate', json={"upload": {"count": 1}})
+        request_code, files = next(iter(response.json().items()))
+
+        # Urls of local and memory storage point to the app
+        put = self.client.put if files[0]['url'].startswith('/') else requests.put
+        with open('tests/images_for_test/testimage.jpg', 'rb') as image:
+            put(files[0]['url'], data=image.read())
+
+        with self.assertMaxQueries(4):
+            response = self.client.post(f'/frames/{self.token}/{request_code}/commit')
+        images = database.query(Inbox).filter(Inbox.request_code == request_code).all()
+        pending = database.query(PendingUpload).filter(PendingUpload.request_code == request_code).all()
+
+        database.query(Inbox).filter(Inbox.request_code == request_code).delete()
+        database.commit()
+        storage.client.remove_object(request_code[:8], files[0]['file_name'] + '.jpg')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {request_code: [
+            {'file_name': image.file_name, 'created_at': format_time(image.created_at)} for image in images
+        ]})
+        self.assertEqual(pending, [])
+
+    def test_commit_upload_not_uploaded(self):
+        database = SessionLocal()
+
+        response = self.client.post(f'/frames/{self.token}/initiate', json={"upload": {"count": 1}})
+        request_code, files = next(iter(response.json().items()))
+
+        response = self.client.post(f'/frames/{self.token}/{request_code}/commit')
+
+        database.query(PendingUpload).filter(PendingUpload.request_code == request_code).delete()
+        database.commit()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'detail': f'Images {files[0]["file_name"]} are not uploaded'})
+
+    def test_commit_upload_of_another_user(self):
+        database = SessionLocal()
+
+        other_user = User(email='moderatortest@test.com', group='moderator', password=get_password_hash('123'))
+        database.add(other_user)
+        database.commit()
+        other_token = AuthToken(token=str(uuid4()), user_id=other_user.id)
+        database.add(other_token)
+        database.commit()
+
+        response = self.client.post(f'/frames/{self.token}/initiate', json={"upload": {"count": 1}})
+        request_code = next(iter(response.json()))
+
+        response = self.client.post(f'/frames/{other_token.token}/{request_code}/commit')
+
+        database.query(PendingUpload).filter(PendingUpload.request_code == request_code).delete()
+        database.query(AuthToken).filter(AuthToken.user_id == other_user.id).delete()
+        database.query(User).filter(User.id == other_user.id).delete()
+        database.commit()
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json(), {'detail': f'Upload with code {request_code} was started by another user'})
+
+    def test_commit_expired_upload(self):
+        database = SessionLocal()
+
+        response = self.client.post(f'/frames/{self.token}/initiate', json={"upload": {"count": 1}})
+        request_code = next(iter(response.json()))
+
+        # Started before PENDING_UPLOAD_TTL, the collector may have removed its objects
+        database.query(PendingUpload).filter(PendingUpload.request_code == request_code).update(
+            {'created_at': datetime(2020, 1, 1, tzinfo=timezone.utc)}
+        )
+        database.commit()
+
+        response = self.client.post(f'/frames/{self.token}/{request_code}/commit')
+
+        database.query(PendingUpload).filter(PendingUpload.request_code == request_code).delete()
+        database.commit()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'detail': f'Upload with code {request_code} is expired'})
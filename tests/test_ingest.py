@@ -0,0 +1,56 @@
+import asyncio
+import fcntl
+import hashlib
+import io
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+from unittest import TestCase
+
+from app.ingest import IngestQueue, MANIFEST
+
+
+class IngestSpoolTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.queue = IngestQueue(self.directory.name, workers=1, maxsize=10, retries=1)
+
+    def test_spool_writes_images_and_manifest(self):
+        created_at = datetime(2022, 6, 1, tzinfo=timezone.utc)
+        file_names = asyncio.run(self.queue.spool('20220601code', created_at, 7, [io.BytesIO(b'a'), io.BytesIO(b'b')]))
+
+        with open(os.path.join(self.directory.name, '20220601code', MANIFEST)) as file:
+            manifest = json.load(file)
+
+        self.assertEqual(manifest, {
+            'request_code': '20220601code',
+            'created_at': created_at.isoformat(),
+            'user_id': 7,
+            'images': [{'file_name': file_names[0], 'key': hashlib.sha256(b'a').hexdigest()},
+                       {'file_name': file_names[1], 'key': hashlib.sha256(b'b').hexdigest()}],
+        })
+        with open(os.path.join(self.directory.name, '20220601code', file_names[1] + '.jpg'), 'rb') as file:
+            self.assertEqual(file.read(), b'b')
+
+    def test_locked_upload_is_skipped(self):
+        asyncio.run(self.queue.spool('20220601code', datetime.now(timezone.utc), 7, [io.BytesIO(b'a')]))
+
+        # Another worker process is saving it
+        with open(os.path.join(self.directory.name, '20220601code', MANIFEST)) as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            asyncio.run(self.queue.process('20220601code'))
+
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, '20220601code', MANIFEST)))
+
+    def test_queue_is_full_before_start(self):
+        self.assertTrue(self.queue.full())
+
+    def test_discarded_upload_is_not_replayed(self):
+        asyncio.run(self.queue.spool('20220601code', datetime.now(timezone.utc), 7, [io.BytesIO(b'a')]))
+
+        self.queue.discard('20220601code')
+
+        self.assertEqual(os.listdir(self.directory.name), [])
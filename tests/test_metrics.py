@@ -0,0 +1,84 @@
+from unittest import TestCase
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from app.metrics import MetricsMiddleware, REQUEST_DURATION, metrics, record_storage, recorded_requests, \
+    instrument_engine, stats_collector
+
+engine = create_engine('sqlite://')
+instrument_engine(engine)
+
+
+def make_app() -> FastAPI:
+    application = FastAPI()
+    application.add_route('/metrics', metrics)
+    application.add_middleware(MetricsMiddleware, server_timing=True)
+
+    @application.get('/items/{item_id}')
+    def read_item(item_id: str):
+        record_storage('stat_object', 0.25)
+        return {'item_id': item_id}
+
+    @application.get('/lists/{count}')
+    def read_list(count: int):
+        # One query per item, like a lazy load in a loop
+        with engine.connect() as connection:
+            return [connection.execute(text('select :number'), {'number': number}).scalar()
+                    for number in range(count)]
+
+    return application
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.client = TestClient(make_app())
+
+    def test_server_timing_has_storage_time(self):
+        response = self.client.get('/items/1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('storage;dur=250.0;desc="1 calls"', response.headers['server-timing'])
+        self.assertIn('db;dur=0.0;desc="0 queries"', response.headers['server-timing'])
+
+    def test_requests_are_labelled_by_handler(self):
+        before = REQUEST_DURATION.labels('GET', 'read_item', '200')._sum.get()
+
+        self.client.get('/items/2')
+        self.client.get('/items/3')
+
+        self.assertGreater(REQUEST_DURATION.labels('GET', 'read_item', '200')._sum.get(), before)
+        self.assertIn('route="read_item"', self.client.get('/metrics').text)
+
+    def test_repeated_statements_are_found(self):
+        with self.assertLogs('app.metrics', 'WARNING') as logs, recorded_requests() as recorded:
+            self.client.get('/lists/3')
+
+        route, timings = recorded[0]
+        self.assertEqual(route, 'read_list')
+        self.assertEqual(timings.db_queries, 3)
+        self.assertEqual(timings.repeated_statements(), {'select ?': 3})
+        self.assertIn('read_list ran the same statement 3 times: select ?', logs.output[0])
+
+    def test_single_statements_are_not_repeated(self):
+        with recorded_requests() as recorded:
+            self.client.get('/lists/1')
+            self.client.get('/items/4')
+
+        self.assertEqual([route for route, timings in recorded], ['read_list', 'read_item'])
+        self.assertEqual([timings.repeated_statements() for route, timings in recorded], [{}, {}])
+
+    def test_stats_are_exported(self):
+        stats = {'checkouts': 3, 'max_wait': 0.5}
+        stats_collector.add('test_pool', 'Test pool', lambda: stats, counters=('checkouts',))
+        self.addCleanup(stats_collector.sources.pop, 'test_pool')
+
+        text = self.client.get('/metrics').text
+        self.assertIn('test_pool_checkouts_total 3.0', text)
+        self.assertIn('# TYPE test_pool_max_wait gauge', text)
+
+        # Read again on every scrape
+        stats['checkouts'] = 4
+        self.assertIn('test_pool_checkouts_total 4.0', self.client.get('/metrics').text)
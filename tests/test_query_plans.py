@@ -0,0 +1,54 @@
+import json
+from unittest import TestCase
+
+from sqlalchemy import delete, func, literal_column, select, text, tuple_
+from sqlalchemy.dialects import postgresql
+
+from app.models import SessionLocal, User, AuthToken, Inbox, Ingest
+
+# Queries which run on every request, each one must be able to use an index
+HOT_QUERIES = {
+    'user by email': select(User.id).where(User.email == 'test@test.com'),
+    'token owner': select(AuthToken.user_id, User.group).join(User, User.id == AuthToken.user_id).where(
+        AuthToken.token == 'token'
+    ),
+    'token by user': select(AuthToken).where(AuthToken.user_id == 1),
+    'images by code': select(Inbox, Ingest.status).outerjoin(Ingest, Ingest.request_code == Inbox.request_code).where(
+        Inbox.request_code == '12345'
+    ),
+    'delete images by code': delete(Inbox).where(Inbox.request_code == '12345'),
+    'codes by time': select(Inbox.created_at, Inbox.request_code, func.count()).where(
+        Inbox.created_at >= literal_column("'2000-01-01'::timestamptz"),
+        tuple_(Inbox.created_at, Inbox.request_code) > tuple_(literal_column("'2000-01-01'::timestamptz"), '12345'),
+    ).group_by(Inbox.created_at, Inbox.request_code).order_by(Inbox.created_at, Inbox.request_code).limit(100),
+}
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class QueryPlanTestCase(TestCase):
+
+    def test_hot_queries_use_indexes(self):
+        database = SessionLocal()
+
+        # Tables in tests are tiny, so seq scans are disabled to see whether an index can be used at all
+        database.execute(text('set local enable_seqscan = off'))
+
+        for name, query in HOT_QUERIES.items():
+            sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+            explain = database.execute(text(f'explain (format json) {sql}')).scalar()
+
+            # psycopg2 decodes json itself, other drivers return a string
+            if isinstance(explain, str):
+                explain = json.loads(explain)
+            plan = explain[0]['Plan']
+
+            seq_scans = [node['Relation Name'] for node in plan_nodes(plan) if node['Node Type'] == 'Seq Scan']
+            self.assertEqual(seq_scans, [], f'{name} falls back to seq scan')
+
+        database.rollback()
+        database.close()
@@ -0,0 +1,72 @@
+import io
+from datetime import datetime
+from unittest import IsolatedAsyncioTestCase
+from uuid import uuid4
+
+from sqlalchemy import text
+
+from app.models import SessionLocal, Inbox, async_engine
+from app.retention import maintain_partitions, partition_ddl, remove_expired_buckets
+from app.storage import storage
+
+
+class InboxRetentionTestCase(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        database = SessionLocal()
+
+        database.execute(text(partition_ddl('20000101')))
+        database.add(Inbox(request_code='20000101000000000', file_name=str(uuid4())))
+        database.commit()
+
+        if not storage.client.bucket_exists('20000101'):
+            storage.client.make_bucket('20000101')
+        storage.client.put_object('20000101', 'test_image.jpg', io.BytesIO(b'image'), 5)
+
+    async def asyncTearDown(self) -> None:
+        # Pooled connections belong to the event loop of this test
+        await async_engine.dispose()
+
+    def tearDown(self) -> None:
+        database = SessionLocal()
+
+        for day in ['20000101', '20000103', '20000104']:
+            database.execute(text(f'drop table if exists inbox_{day}'))
+        database.commit()
+
+    async def test_expired_days_are_dropped(self):
+        now = datetime(2000, 1, 3)
+
+        self.assertEqual(await maintain_partitions(1, now), ['20000101'])
+        self.assertIn('20000101', await remove_expired_buckets(1, now))
+
+        database = SessionLocal()
+        images = database.query(Inbox).filter(Inbox.request_code == '20000101000000000').all()
+        database.close()
+
+        self.assertEqual(images, [])
+        self.assertFalse(storage.client.bucket_exists('20000101'))
+
+    async def test_expired_days_are_deleted_from_default_partition(self):
+        database = SessionLocal()
+        database.add(Inbox(request_code='19991231000000000', file_name=str(uuid4())))
+        database.add(Inbox(request_code='1999code', file_name=str(uuid4())))
+        database.commit()
+
+        await maintain_partitions(1, datetime(2000, 1, 3))
+
+        # The day has no partition of its own, codes which are not days stay
+        expired = database.query(Inbox).filter(Inbox.request_code == '19991231000000000').all()
+        kept = database.query(Inbox).filter(Inbox.request_code == '1999code').delete()
+        database.commit()
+        database.close()
+
+        self.assertEqual(expired, [])
+        self.assertEqual(kept, 1)
+
+    async def test_partitions_of_today_and_tomorrow_are_made(self):
+        await maintain_partitions(0, datetime(2000, 1, 3))
+
+        database = SessionLocal()
+        tables = database.execute(text("select tablename from pg_tables where tablename like 'inbox_2000%'"))
+        self.assertEqual(sorted(tables.scalars().all()), ['inbox_20000101', 'inbox_20000103', 'inbox_20000104'])
@@ -0,0 +1,59 @@
+import io
+import time
+from unittest import TestCase
+
+import anyio
+
+from app.backends import MemoryBackend, StorageError
+from app.storage import Storage
+
+
+class FlakyBackend(MemoryBackend):
+    # Refuses objects named fail*, the first object is slow so puts finish out of order
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, **kwargs):
+        if object_name.startswith('fail'):
+            raise StorageError('AccessDenied', f'Object {object_name} is not allowed')
+        if object_name == 'a.jpg':
+            time.sleep(0.1)
+        super().put_object(bucket_name, object_name, data, length, **kwargs)
+
+
+class PutObjectsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.backend = FlakyBackend()
+        self.backend.make_bucket('20220101')
+        self.storage = Storage(self.backend, 4)
+
+    def put_objects(self, names: list):
+        objects = [(name, io.BytesIO(name.encode()), len(name)) for name in names]
+        anyio.run(self.storage.put_objects, '20220101', objects, 4)
+
+    def test_objects_get_their_own_data(self):
+        self.put_objects(['a.jpg', 'b.jpg', 'c.jpg'])
+
+        self.assertEqual(sorted(self.backend.list_objects('20220101')), ['a.jpg', 'b.jpg', 'c.jpg'])
+        for name in ['a.jpg', 'b.jpg', 'c.jpg']:
+            self.assertEqual(self.backend.get_object('20220101', name).read(), name.encode())
+
+    def test_failed_put_removes_other_objects(self):
+        with self.assertRaises(StorageError) as error:
+            self.put_objects(['a.jpg', 'fail.jpg', 'b.jpg'])
+
+        self.assertEqual(error.exception.code, 'AccessDenied')
+        self.assertEqual(self.backend.list_objects('20220101'), [])
+
+    def test_missing_bucket_is_made_again(self):
+        self.storage.known_buckets.add('20220102')
+
+        objects = [('a.jpg', io.BytesIO(b'first'), 5)]
+        anyio.run(self.storage.put_objects, '20220102', objects, 4)
+
+        self.assertEqual(self.backend.get_object('20220102', 'a.jpg').read(), b'first')
+
+    def test_put_object_makes_missing_bucket(self):
+        # Derivatives and presigned PUTs write single objects, e.g. just after midnight before the bucket is made
+        anyio.run(self.storage.put_object, '20220103', 'b.jpg', io.BytesIO(b'second'), 6)
+
+        self.assertEqual(self.backend.get_object('20220103', 'b.jpg').read(), b'second')
@@ -0,0 +1,38 @@
+import asyncio
+from unittest import TestCase
+
+from app.config import PASSWORD_HASH_ALGORITHM
+from app.utils import HASHERS, Pbkdf2Hasher, ScryptHasher, dummy_hash, get_password_hash, verify, verify_password
+
+
+class PasswordHashTestCase(TestCase):
+
+    def test_old_sha256_hash_is_valid_and_replaced(self):
+        self.assertEqual(verify('123', get_password_hash('123')), (True, True))
+        self.assertEqual(verify('124', get_password_hash('123')), (False, False))
+
+    def test_scrypt(self):
+        hasher = ScryptHasher(2 ** 10, 8, 1)
+        encoded = hasher.hash('123')
+
+        self.assertTrue(encoded.startswith('scrypt$1024$8$1$'))
+        self.assertTrue(hasher.verify('123', encoded))
+        self.assertFalse(hasher.verify('124', encoded))
+        self.assertTrue(ScryptHasher(2 ** 11, 8, 1).needs_rehash(encoded))
+
+    def test_pbkdf2(self):
+        hasher = Pbkdf2Hasher(1000)
+        encoded = hasher.hash('123')
+
+        self.assertTrue(hasher.verify('123', encoded))
+        self.assertFalse(hasher.verify('124', encoded))
+        self.assertFalse(hasher.needs_rehash(encoded))
+        self.assertTrue(Pbkdf2Hasher(2000).needs_rehash(encoded))
+
+    def test_same_password_gets_different_salt(self):
+        hasher = HASHERS['pbkdf2_sha256']
+        self.assertNotEqual(hasher.hash('123'), hasher.hash('123'))
+
+    def test_unknown_user_is_checked_against_dummy_hash(self):
+        self.assertEqual(asyncio.run(verify_password('123', None)), (False, False))
+        self.assertTrue(dummy_hash().startswith(PASSWORD_HASH_ALGORITHM + '$'))